@@ -46,6 +46,23 @@ LOGGING = {
 
 LOGIN_URL = 'http://127.0.0.1:8000/login/'
 
+# Limits of every Symphony execution requested through the web page, so a
+# program stuck in an infinite loop (or recursion) doesn't keep a worker busy
+# forever
+SYMPHONY_MAX_STEPS = 10_000_000
+SYMPHONY_TIMEOUT = 5
+SYMPHONY_MAX_CALL_DEPTH = 10_000
+# Whether the results of pure functions are reused. Turn it off to let
+# students see how many calls their recursive functions really make
+SYMPHONY_MEMOIZE = True
+# Most characters printed and notes played by a program that are sent back,
+# so a program printing forever doesn't fill the server's memory
+SYMPHONY_MAX_OUTPUT = 1_000_000
+SYMPHONY_MAX_NOTES = 100_000
+# Whether every array access checks its index, even the ones the optimizer
+# proves in range. Only useful when debugging the VM
+SYMPHONY_KEEP_BOUNDS_CHECKS = False
+
 ALLOWED_HOSTS = []
 
 
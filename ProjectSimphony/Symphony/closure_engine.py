@@ -0,0 +1,227 @@
+"""Execution engine running programs as lists of closures.
+
+Before running, each instruction is compiled into a closure with its operands
+already bound: constants are bound by value and other addresses by the memory
+sector holding them. Running a quadruple is then a single call which returns
+the index of the next one, with no handler lookup or address decoding at all.
+
+The closures belong to a single Orchestra, which still keeps all the runtime
+state, so both engines behave exactly the same.
+"""
+
+from functools import partial
+from Symphony.lexer import OPERATORS
+from Symphony.orchestra import (OPERATIONS, sector_of, uninitialized_error,
+                                division_error, index_error)
+
+
+def reader(vm, address):
+    """Return a function without arguments reading an address
+
+    A missing value raises an UninitializedError
+    """
+    sector = sector_of(address)
+    constants = vm.memory['constant']
+
+    if sector == 'constant' and address in constants:
+        value = constants[address]
+        return lambda: value
+    elif sector == 'local':
+        # The local frame changes with every call, so it's looked up each time
+        memory = vm.memory
+
+        def read():
+            try:
+                return memory['local'][address]
+            except KeyError as e:
+                raise uninitialized_error() from e
+
+        return read
+
+    values = vm.memory[sector]
+
+    def read():
+        try:
+            return values[address]
+        except KeyError as e:
+            raise uninitialized_error() from e
+
+    return read
+
+
+def writer(vm, address):
+    """ Return a function receiving the value to store in an address """
+    if sector_of(address) == 'local':
+        memory = vm.memory
+
+        def write(value):
+            memory['local'][address] = value
+
+        return write
+
+    return partial(vm.memory[sector_of(address)].__setitem__, address)
+
+
+def storage(vm, base_address):
+    """ Return a function returning the storage of an array """
+    if sector_of(base_address) == 'local':
+        # Local arrays belong to the frame, like any other local variable
+        memory = vm.memory
+        return lambda: memory['local'][base_address]
+
+    array = vm.memory[sector_of(base_address)][base_address]
+    return lambda: array
+
+
+def binary_step(vm, operation, address1, address2, result_address, next_pc):
+    read1, read2 = reader(vm, address1), reader(vm, address2)
+    write = writer(vm, result_address)
+
+    def step():
+        value1 = read1()
+        value2 = read2()
+
+        try:
+            write(operation(value1, value2))
+        except ZeroDivisionError as e:
+            raise division_error(value1) from e
+
+        return next_pc
+
+    return step
+
+
+def unary_step(vm, operation, address, result_address, next_pc):
+    read, write = reader(vm, address), writer(vm, result_address)
+
+    if operation is OPERATIONS['=']:
+        def step():
+            write(read())
+            return next_pc
+    else:
+        def step():
+            write(operation(read()))
+            return next_pc
+
+    return step
+
+
+def goto_step(vm, quad_idx, target, limited):
+    if limited:
+        return partial(vm.jumped, quad_idx, target)
+
+    return lambda: target
+
+
+def gotof_step(vm, quad_idx, address, target, next_pc, limited):
+    read = reader(vm, address)
+    jumped = vm.jumped
+
+    if limited:
+        def step():
+            if not read():
+                return jumped(quad_idx, target)
+            return next_pc
+    else:
+        def step():
+            if not read():
+                return target
+            return next_pc
+
+    return step
+
+
+def load_step(vm, base_address, offset_address, array_size, result_address,
+              next_pc, checked=True):
+    read_offset = reader(vm, offset_address)
+    write = writer(vm, result_address)
+    array = storage(vm, base_address)
+
+    def step():
+        offset = read_offset()
+        if checked and not 0 <= offset < array_size:
+            raise index_error(offset, array_size)
+
+        storage = array()
+        if not storage.assigned[offset]:
+            raise uninitialized_error()
+        write(storage.values[offset])
+        return next_pc
+
+    return step
+
+
+def store_step(vm, value_address, base_address, offset_address, array_size,
+               next_pc, checked=True):
+    read_value = reader(vm, value_address)
+    read_offset = reader(vm, offset_address)
+    array = storage(vm, base_address)
+
+    def step():
+        offset = read_offset()
+        if checked and not 0 <= offset < array_size:
+            raise index_error(offset, array_size)
+
+        array().store(offset, read_value())
+        return next_pc
+
+    return step
+
+
+def handler_step(vm, quad_idx, instruction, next_pc, limited):
+    """ Run any other instruction through its Orchestra handler """
+    handler, operands = instruction.handler, instruction.operands
+    jumped = vm.jumped
+
+    def step():
+        target = handler(vm, *operands)
+        if target is None:
+            return next_pc
+        elif limited:
+            return jumped(quad_idx, target)
+        return target
+
+    return step
+
+
+def compile_instruction(vm, quad_idx, instruction, limited):
+    """ Compile a decoded instruction into a closure bound to a VM """
+    opcode, operands = instruction.opcode, instruction.operands
+    next_pc = quad_idx + 1
+
+    if opcode in OPERATORS:
+        return binary_step(vm, OPERATIONS[opcode], *operands, next_pc)
+    elif opcode in OPERATIONS:
+        return unary_step(vm, OPERATIONS[opcode], *operands, next_pc)
+    elif opcode == 'GOTO':
+        return goto_step(vm, quad_idx, *operands, limited)
+    elif opcode == 'GOTOF':
+        return gotof_step(vm, quad_idx, *operands, next_pc, limited)
+    elif opcode == 'LOAD':
+        return load_step(vm, *operands, next_pc)
+    elif opcode == 'STORE':
+        return store_step(vm, *operands, next_pc)
+    elif opcode == 'LOADU':
+        base_address, offset_address, result_address = operands
+        return load_step(vm, base_address, offset_address, None,
+                         result_address, next_pc, checked=False)
+    elif opcode == 'STOREU':
+        value_address, base_address, offset_address = operands
+        return store_step(vm, value_address, base_address, offset_address,
+                          None, next_pc, checked=False)
+
+    return handler_step(vm, quad_idx, instruction, next_pc, limited)
+
+
+def play_closures(vm, program):
+    """ Run a decoded program in a VM and return its output """
+    limited = vm.start_limits()
+    steps = [compile_instruction(vm, quad_idx, instruction, limited)
+             for quad_idx, instruction in enumerate(program)]
+
+    pc = 0
+    end = len(steps)
+    while pc < end:
+        pc = steps[pc]()
+
+    return vm.output_after_cleanup()
@@ -0,0 +1,292 @@
+"""Control flow graph of a program's quadruples.
+
+The quadruples are split into basic blocks (runs of quadruples which always
+execute together, from the first to the last) linked by the jumps between them.
+On top of the graph, the immediate dominator of every block (with the
+algorithm of Cooper, Harvey and Kennedy) and the natural loops of the program
+(nested within each other) are computed.
+
+Functions are analysed like separate graphs: their first block is an entry
+of the program, like its first quadruple, and a GOSUB simply continues with
+the quadruple after it (where the call comes back to). ENDPROC and TAILCALL
+(which never comes back) have no successors.
+"""
+
+# Position of the target in each jump quadruple
+JUMP_TARGETS = {'GOTO': 1, 'GOTOF': 2}
+
+# Quadruples after which the next one starts a new block
+BLOCK_ENDS = {'GOTO', 'GOTOF', 'GOSUB', 'ENDPROC', 'TAILCALL'}
+
+# Immediate dominator of the entries: a block before all of them
+ROOT = -1
+
+
+class BasicBlock():
+    """Quadruples from start up to end (not included) of a control flow graph
+
+    Successors and predecessors are indices of other blocks in the same graph.
+    loop is the innermost loop containing the block (None outside of loops)
+    """
+    def __init__(self, index, start, end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.successors = []
+        self.predecessors = []
+        self.loop = None
+
+
+    def quad_indices(self):
+        """ Return the indices of the block's quadruples """
+        return range(self.start, self.end)
+
+
+class Loop():
+    """Natural loop of a control flow graph
+
+    header is the index of the only block through which the loop is entered
+    and blocks has the indices of every block in the loop (header included).
+    back_edges are the blocks jumping back to the header. Loops inside it are
+    its children
+    """
+    def __init__(self, header, blocks, back_edges):
+        self.header = header
+        self.blocks = blocks
+        self.back_edges = back_edges
+        self.parent = None
+        self.children = []
+
+
+    def depth(self):
+        """ Return how many loops contain this one (itself included) """
+        depth = 1
+        loop = self.parent
+        while loop is not None:
+            depth += 1
+            loop = loop.parent
+        return depth
+
+
+class ControlFlowGraph():
+    """Basic blocks of a list of split quadruples and the jumps between them
+
+    The directory gives the starting quadruple of every function. The graph
+    is only valid until the quadruples change
+    """
+    def __init__(self, quads, directory):
+        self.quads = quads
+        self.blocks = []
+        # Block containing each quadruple
+        self.block_at = []
+
+        starts = {function.starting_quad for function
+                  in directory.functions.values()} | {0}
+        self.split_blocks(starts)
+        self.link_blocks()
+
+        # Blocks where execution begins: the program's and functions' starts
+        self.entries = sorted({self.block_at[start] for start in starts
+                               if start < len(quads)})
+        self.immediate_dominators = self.find_immediate_dominators()
+        # Position of each block when entering and leaving it in a walk of
+        # the dominator tree, so a block dominates the ones it encloses
+        self.tree_entry = {}
+        self.tree_exit = {}
+        self.number_dominator_tree()
+        self.loops = self.find_loops()
+
+
+    def split_blocks(self, starts):
+        """ Create the blocks, each starting at a leader """
+        leaders = set(starts)
+        for quad_idx, quad in enumerate(self.quads):
+            if quad[0] in BLOCK_ENDS:
+                leaders.add(quad_idx + 1)
+            if quad[0] in JUMP_TARGETS:
+                leaders.add(int(quad[JUMP_TARGETS[quad[0]]]))
+
+        leaders = sorted(leader for leader in leaders
+                         if 0 <= leader < len(self.quads))
+        for start, end in zip(leaders, leaders[1:] + [len(self.quads)]):
+            block = BasicBlock(len(self.blocks), start, end)
+            self.blocks.append(block)
+            self.block_at.extend([block.index] * (end - start))
+
+
+    def link_blocks(self):
+        """ Add the edges of every jump and every fall through """
+        for block in self.blocks:
+            last = self.quads[block.end - 1]
+            targets = []
+
+            if last[0] in JUMP_TARGETS:
+                targets.append(int(last[JUMP_TARGETS[last[0]]]))
+            if last[0] not in ('GOTO', 'ENDPROC', 'TAILCALL'):
+                targets.append(block.end)
+
+            for target in targets:
+                # Jumping to the end of the program finishes it
+                if target >= len(self.quads):
+                    continue
+
+                successor = self.blocks[self.block_at[target]]
+                if successor.index not in block.successors:
+                    block.successors.append(successor.index)
+                    successor.predecessors.append(block.index)
+
+
+    def reachable_blocks(self):
+        """ Return the blocks in reverse postorder from the entries """
+        visited = set()
+        postorder = []
+
+        for entry in self.entries:
+            pending = [(entry, iter(self.blocks[entry].successors))]
+            visited.add(entry)
+            while pending:
+                block, successors = pending[-1]
+                for successor in successors:
+                    if successor not in visited:
+                        visited.add(successor)
+                        pending.append(
+                            (successor,
+                             iter(self.blocks[successor].successors)))
+                        break
+                else:
+                    pending.pop()
+                    postorder.append(block)
+
+        return postorder[::-1]
+
+
+    def find_immediate_dominators(self):
+        """Return the immediate dominator of each block
+
+        A block dominates another if every path from an entry to the latter
+        goes through it, and the immediate dominator is the closest of them.
+        Entries get ROOT and blocks that can't be reached get None
+        """
+        order = self.reachable_blocks()
+        number = {block: position for position, block in enumerate(order)}
+        number[ROOT] = -1
+        dominators = [None] * len(self.blocks)
+        for entry in self.entries:
+            dominators[entry] = ROOT
+
+        def intersect(block1, block2):
+            # Climb from the deepest block until both paths meet
+            while block1 != block2:
+                while number[block1] > number[block2]:
+                    block1 = dominators[block1]
+                while number[block2] > number[block1]:
+                    block2 = dominators[block2]
+            return block1
+
+        changed = True
+        while changed:
+            changed = False
+            for block in order:
+                if block in self.entries:
+                    continue
+
+                new_dominator = None
+                for predecessor in self.blocks[block].predecessors:
+                    if dominators[predecessor] is None:
+                        continue
+                    elif new_dominator is None:
+                        new_dominator = predecessor
+                    else:
+                        new_dominator = intersect(predecessor, new_dominator)
+
+                if new_dominator != dominators[block]:
+                    dominators[block] = new_dominator
+                    changed = True
+
+        return dominators
+
+
+    def number_dominator_tree(self):
+        """ Number the blocks in a depth-first walk of the dominator tree """
+        children = {}
+        for block, dominator in enumerate(self.immediate_dominators):
+            if dominator is not None:
+                children.setdefault(dominator, []).append(block)
+
+        counter = 0
+        pending = [(ROOT, iter(children.get(ROOT, [])))]
+        while pending:
+            block, block_children = pending[-1]
+            for child in block_children:
+                self.tree_entry[child] = counter
+                counter += 1
+                pending.append((child, iter(children.get(child, []))))
+                break
+            else:
+                pending.pop()
+                self.tree_exit[block] = counter
+                counter += 1
+
+
+    def find_loops(self):
+        """Return the natural loops of the graph, outermost ones first
+
+        A jump to a block dominating its source closes a loop. Loops sharing a
+        header are merged
+        """
+        back_edges = {}
+        for block in self.blocks:
+            for successor in block.successors:
+                if self.dominates(successor, block.index):
+                    back_edges.setdefault(successor, []).append(block.index)
+
+        loops = []
+        for header, sources in sorted(back_edges.items()):
+            blocks = {header}
+            pending = list(sources)
+            while pending:
+                block = pending.pop()
+                if block not in blocks:
+                    blocks.add(block)
+                    pending.extend(self.blocks[block].predecessors)
+
+            loops.append(Loop(header, blocks, sources))
+
+        # Each loop belongs to the smallest loop containing its header
+        loops.sort(key=lambda loop: len(loop.blocks), reverse=True)
+        for loop_idx, loop in enumerate(loops):
+            for outer in reversed(loops[:loop_idx]):
+                if loop.header in outer.blocks:
+                    loop.parent = outer
+                    outer.children.append(loop)
+                    break
+
+            for block in loop.blocks:
+                self.blocks[block].loop = loop
+
+        return loops
+
+
+    def block_of(self, quad_idx):
+        """ Return the block containing a quadruple """
+        return self.blocks[self.block_at[quad_idx]]
+
+
+    def dominates(self, dominator, block):
+        """Check if a block (index) dominates another
+
+        Blocks that can't be reached are only dominated by themselves
+        """
+        if dominator == block:
+            return True
+        elif block not in self.tree_entry or dominator not in self.tree_entry:
+            return False
+
+        return (self.tree_entry[dominator] < self.tree_entry[block]
+                and self.tree_exit[block] < self.tree_exit[dominator])
+
+
+    def loop_depth(self, quad_idx):
+        """ Return how many loops contain a quadruple """
+        loop = self.block_of(quad_idx).loop
+        return 0 if loop is None else loop.depth()
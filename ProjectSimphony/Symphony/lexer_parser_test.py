@@ -2,15 +2,34 @@ from print_colors import print_red
 
 from lexer import lexer
 from glob import glob
+from random import seed
+from io import StringIO
+from os.path import join
+from shutil import copy
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
+from Symphony.orchestra import (decode_program, UninitializedError,
+                                ExecutionLimitExceeded, CallDepthExceeded)
+from Symphony.program_cache import ProgramCache
+from Symphony.output_sinks import BufferedOutput, CallbackOutput
+from Symphony.control_flow import ControlFlowGraph
 from symphony_parser import (
-    create_parser,
+    compile_program,
     GrammaticalError,
     RedeclarationError,
     MisplacedStatementError,
     ArityError,
+    AddressOverflowError,
+    execute_code,
+    ENGINES,
+    run_program,
+    stream_program,
     parse,
+    parse_file,
 )
+from time import perf_counter
 from unittest import TestCase, main
+from unittest.mock import patch
 
 
 VALID_PROGRAMS_PATH = 'tests/valid_symphonies/'
@@ -19,6 +38,7 @@ REDECLARATION_PATH = 'tests/redeclaration/'
 UNDECLARED_PATH = 'tests/undeclared_usages/'
 WRONG_TYPES_PATH = 'tests/wrong_types/'
 ARITY_PATH = 'tests/arity/'
+OVERFLOW_PATH = 'tests/overflow/'
 MISPLACED_PATH = 'tests/misplaced/'
 
 
@@ -71,14 +91,12 @@ class ParserTest(TestCase):
         for invalid_program in glob(path + '*.sym'):
             for_entered = True
 
-            self.parser = create_parser(invalid_program)
-
             try:
                 with open(invalid_program) as file:
 
                     with self.assertRaises(RaisedError) as exception_context:
                         print('Testing', invalid_program + '...', end=' ')
-                        self.parser.parse(file.read())
+                        compile_program(file.read())
 
                     # print(str(exception_context.exception))
             except:
@@ -93,12 +111,10 @@ class ParserTest(TestCase):
         for valid_program in glob(VALID_PROGRAMS_PATH + '*.sym'):
             for_entered = True
 
-            self.parser = create_parser(valid_program)
-
             try:
                 with open(valid_program) as file:
                     print('Testing', valid_program + '...', end=' ')
-                    self.parser.parse(file.read())
+                    compile_program(file.read())
             except:
                 print('\033[91m Error!\033[0m')
                 raise
@@ -106,6 +122,21 @@ class ParserTest(TestCase):
         if not for_entered:
             raise Exception(f'No files could be found in {VALID_PROGRAMS_PATH}')
 
+    def test_concurrent_compilation(self):
+        sources = []
+        for valid_program in sorted(glob(VALID_PROGRAMS_PATH + '*.sym')):
+            with open(valid_program) as file:
+                sources.append(file.read())
+
+        def compile_quadruples(source):
+            return compile_program(source).quadruples
+
+        expected = [compile_quadruples(source) for source in sources]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            actual = list(executor.map(compile_quadruples, sources * 4))
+
+        self.assertEqual(actual, expected * 4)
+
     def test_grammar(self):
         self.assert_programs_raise(GRAMMAR_PATH, GrammaticalError)
 
@@ -124,11 +155,440 @@ class ParserTest(TestCase):
     def test_misplaced(self):
         self.assert_programs_raise(MISPLACED_PATH, MisplacedStatementError)
 
+    def test_overflow(self):
+        self.assert_programs_raise(OVERFLOW_PATH, AddressOverflowError)
+
+    def test_temporal_reuse(self):
+        source = 'program temps; int a; a = 2; println(a + a * a - a + a * a);'
+        quadruples = compile_program(source, optimize=False).quadruples
+
+        temporals = {quad.split()[-1] for quad in quadruples
+                     if quad.split()[0] in ('+', '-', '*')}
+        self.assertEqual(len(temporals), 3)
+
+    def test_temporals_across_recursive_calls(self):
+        source = ('program recursion; '
+                  'fun int f(int n) { int r; '
+                  'if (n < 1) { r = 1; } '
+                  'else { r = (n + 1) * f(n - 1) + (n * 2) * f(n - 1); } '
+                  'return r; } '
+                  'print(f(4));')
+
+        # The pending products are kept by each call, not shared by all
+        for optimize in (True, False):
+            program = compile_program(source, optimize=optimize)
+            for engine in ENGINES:
+                self.assertEqual(run_program(program, engine=engine,
+                                             memoize=False), ('3640', []))
+
 
 class OrchestraTest(TestCase):
     def test_right(self):
         parse(glob(VALID_PROGRAMS_PATH + '*.sym'))
 
+    def test_decode_program(self):
+        load, call = decode_program(['LOAD 10000 130000 5 130001', 'GOSUB f'])
+
+        self.assertEqual(load.operands, (10000, 130000, 5, 130001))
+        # Calls also receive the quadruple they return to
+        self.assertEqual(call.operands, ('f', 2))
+
+        with self.assertRaises(ArityError):
+            decode_program(['STORE 130000 10000 5'])
+
+    def test_array_element_update(self):
+        source = ('program update; int a[2]; a[1] = 4; ++a[1]; --a[1]; '
+                  '++a[1]; print(a[1]);')
+        self.assertEqual(execute_code(source), ('5', []))
+
+    def test_copy_into_array_element(self):
+        source = ('program copies; str a[2], s; int i; s = "hi"; '
+                  'a[0] = "x"; copy(s, a[0]); println(a[0]); '
+                  'i = 0; while (i < 2) { a[i] = "y"; i = i + 1; } '
+                  'copy("zz", a[i - 1]); print(a[1]);')
+
+        for optimize in (True, False):
+            program = compile_program(source, optimize=optimize)
+            for engine in ENGINES:
+                self.assertEqual(run_program(program, engine=engine),
+                                 ('hi\nzz', []))
+
+    def test_array_storage(self):
+        source = ('program storage; int a[3]; dec d[2]; bool b[2]; '
+                  'fun int local(int n) { str s[2]; s[1] = "x"; '
+                  'return length(s[1]) + n; } '
+                  'a[0] = 2 ** 70; a[1] = 2 ** -1; d[1] = 0.5; b[0] = true; '
+                  'println(a[0]); println(a[1]); println(d[1]); '
+                  'println(b[0]); print(local(1));')
+        unassigned = ('program unassigned; dec d[2]; int i; i = 1; '
+                      'd[0] = 1.5; print(d[i]);')
+
+        for engine in ENGINES:
+            # Integers over 64 bits and bools keep their values
+            self.assertEqual(execute_code(source, engine=engine),
+                             (f'{2 ** 70}\n0.5\n0.5\ntrue\n2', []))
+            with self.assertRaises(UninitializedError):
+                execute_code(unassigned, engine=engine)
+
+    def test_unassigned_variables(self):
+        source = 'program unassigned; int a, b; b = a + 1; print(b);'
+
+        for optimize in (True, False):
+            program = compile_program(source, optimize=optimize)
+            for engine in ENGINES:
+                with self.assertRaises(UninitializedError):
+                    run_program(program, engine=engine)
+
+    def test_lazy_transpilation(self):
+        program = compile_program('program lazy; print(1);')
+        run_program(program)
+        self.assertIsNone(program.code)
+
+        self.assertEqual(run_program(program, engine='transpiled'),
+                         ('1', []))
+        self.assertIsNotNone(program.code)
+        self.assertIs(program.transpiled(), program.code)
+
+    def test_arguments_read_before_call(self):
+        prints, _ = parse_file(VALID_PROGRAMS_PATH + 'swapped_arguments.sym')
+        self.assertEqual(prints, '23')
+
+    def test_save_note(self):
+        with TemporaryDirectory() as directory:
+            path = join(directory, 'swapped_arguments.sym')
+            copy(VALID_PROGRAMS_PATH + 'swapped_arguments.sym', path)
+            self.assertEqual(parse_file(path, save_note=True), ('23', []))
+
+            with open(path) as file:
+                program = compile_program(file.read())
+            with open(path[:-4] + '.note') as file:
+                self.assertEqual(file.read(), '\n'.join(program.quadruples))
+
+    def test_executions_do_not_share_memory(self):
+        parse_file(VALID_PROGRAMS_PATH + 'simple_array.sym')
+
+        with self.assertRaises(UninitializedError):
+            parse_file(VALID_PROGRAMS_PATH + 'uninitialized.sym')
+
+    def test_input_streams(self):
+        source = ('program total; int n, total; total = 0; '
+                  'n = length(input()); while (n > 0) { '
+                  'total = total + length(input()); n = n - 1; } '
+                  'print(total);')
+        self.assertEqual(execute_code(source, 'ab\nx\nyy'), ('3', []))
+        self.assertEqual(execute_code(source, StringIO('ab\nx\nyy\n')),
+                         ('3', []))
+
+        # Lines are only produced when the program reads them
+        lines = (str(line) for line in range(1, 10 ** 9))
+        self.assertEqual(execute_code(source, lines,
+                                      allow_unconsumed_input=True), ('1', []))
+        self.assertEqual(next(lines), '3')
+
+        with self.assertRaises(ArityError):
+            execute_code(source, 'ab\nx\nyy\nleft over')
+        with self.assertRaises(ArityError):
+            execute_code(source, 'ab\nx', allow_unconsumed_input=True)
+
+    def test_output_sinks(self):
+        source = ('program counting; int i; i = 0; '
+                  'while (i < 3) { println(i); A(); i = i + 1; }')
+        printed = []
+        notes = []
+        output = CallbackOutput(printed.append, notes.append)
+        self.assertIsNone(execute_code(source, output=output))
+        self.assertEqual(printed, ['0\n', '1\n', '2\n'])
+        self.assertEqual(len(notes), 3)
+
+        output = BufferedOutput(max_length=3, max_notes=1)
+        prints, notes = execute_code(source, output=output)
+        self.assertEqual((prints, len(notes)), ('0\n1', 1))
+        self.assertTrue(output.truncated)
+
+        program = compile_program(source)
+        items = list(stream_program(program, max_pending=1))
+        self.assertEqual([text for kind, text in items if kind == 'print'],
+                         ['0\n', '1\n', '2\n'])
+
+        # Closing the stream early stops an endless program
+        endless = compile_program('program endless; while (true) { '
+                                  'println(1); }')
+        stream = stream_program(endless, max_pending=1)
+        self.assertEqual(next(stream), ('print', '1\n'))
+        stream.close()
+
+        with self.assertRaises(UninitializedError):
+            list(stream_program(compile_program(
+                'program broken; int i; println(0); print(i);')))
+
+    def test_execution_limits(self):
+        endless_loop = 'program endless; int i; i = 0; while(true) { ++i; }'
+
+        for engine in ENGINES:
+            with self.assertRaises(ExecutionLimitExceeded) as context:
+                execute_code(endless_loop, max_steps=1000, engine=engine)
+            self.assertIn(context.exception.quad_idx, range(1, 5))
+
+            with self.assertRaises(ExecutionLimitExceeded):
+                execute_code(endless_loop, timeout=0.1, engine=engine)
+
+    def test_call_depth(self):
+        recursion = ('program recursion; '
+                     'fun int depth(int n) { int r; '
+                     'if (n > 0) { r = depth(n - 1) + 1; } else { r = 0; } '
+                     'return r; } '
+                     'print(depth(50));')
+
+        for engine in ENGINES:
+            self.assertEqual(execute_code(recursion, max_call_depth=51,
+                                          engine=engine), ('50', []))
+            with self.assertRaises(CallDepthExceeded):
+                execute_code(recursion, max_call_depth=50, engine=engine)
+
+    def test_memoization(self):
+        source = ('program memo; int calls; '
+                  'fun int fib(int n) { int r; '
+                  'if (n < 2) { r = n; } '
+                  'else { r = fib(n - 1) + fib(n - 2); } '
+                  'return r; } '
+                  'fun int counted(int n) { calls = calls + 1; return n; } '
+                  'calls = 0; '
+                  'println(fib(25)); '
+                  'println(counted(1) + counted(1)); '
+                  'print(calls);')
+        program = compile_program(source)
+        self.assertTrue(program.directory.functions['fib'].pure)
+        self.assertFalse(program.directory.functions['counted'].pure)
+
+        # Only a memoized fib runs in so few steps
+        for engine in ENGINES:
+            self.assertEqual(execute_code(source, max_steps=10_000,
+                                          engine=engine),
+                             ('75025\n2\n2', []))
+            with self.assertRaises(ExecutionLimitExceeded):
+                execute_code(source, max_steps=10_000, engine=engine,
+                             memoize=False)
+
+    def test_engines_match(self):
+        def run(path, engine):
+            # special_functions.sym reads two lines and prints random numbers
+            seed(0)
+            inputs = 'first\nsecond' if 'special_functions' in path else None
+
+            try:
+                return parse_file(path, inputs, engine=engine)
+            except Exception as e:
+                return type(e), str(e)
+
+        for path in glob(VALID_PROGRAMS_PATH + '*.sym'):
+            expected = run(path, 'dispatch')
+            for engine in ENGINES:
+                self.assertEqual(run(path, engine), expected, (path, engine))
+
+    def test_internal_errors_propagate(self):
+        def broken_sink(text):
+            raise KeyError('sink bug')
+
+        source = ('program broken; int i; i = 0; '
+                  'while (i < 2) { i = i + 1; } print(i);')
+
+        # Only reading an unassigned variable is the program's fault
+        for engine in ENGINES:
+            with self.assertRaises(KeyError):
+                execute_code(source, engine=engine,
+                             output=CallbackOutput(broken_sink))
+
+
+class OptimizerTest(TestCase):
+    def test_constant_folding(self):
+        source = ('program folding; int x; x = 2 * 3 + 1; '
+                  'if (x > 10) { print(x); } else { println(x); } '
+                  'while (true) { print(1 / 0); }')
+        program = compile_program(source)
+
+        opcodes = [quad.split()[0] for quad in program.quadruples]
+        self.assertNotIn('*', opcodes)
+        self.assertNotIn('+', opcodes)
+        # Only the if's condition is checked at runtime
+        self.assertEqual(opcodes.count('GOTOF'), 1)
+
+        with self.assertRaises(ZeroDivisionError):
+            run_program(program)
+        with self.assertRaises(ZeroDivisionError):
+            run_program(compile_program(source, optimize=False))
+
+    def test_peephole(self):
+        source = ('program peephole; int i; i = 0; '
+                  'while (i < 3) { if (i > 1) { print(i); } i = i + 1; }')
+        program = compile_program(source)
+
+        # i = i + 1 is a single quadruple writing to i (10000)
+        self.assertIn('+ 10000 200002 10000', program.quadruples)
+        # The GOTO to main is dropped, only the while's GOTO is left
+        opcodes = [quad.split()[0] for quad in program.quadruples]
+        self.assertEqual(opcodes.count('GOTO'), 1)
+        self.assertEqual(run_program(program), ('2', []))
+
+    def test_bounds_check_elimination(self):
+        source = ('program bounds; int a[3], i; a[0] = 4; i = 0; '
+                  'while (i < 3) { a[i] = a[0] + i; i = i + 1; } '
+                  'print(a[2]);')
+        opcodes = [quad.split()[0]
+                   for quad in compile_program(source).quadruples]
+        self.assertNotIn('LOAD', opcodes)
+        self.assertEqual(opcodes.count('STOREU'), 2)
+        self.assertEqual(execute_code(source), ('6', []))
+
+        opcodes = [quad.split()[0] for quad in compile_program(
+            source, keep_bounds_checks=True).quadruples]
+        self.assertEqual(opcodes.count('LOAD'), 2)
+        self.assertEqual(opcodes.count('STORE'), 2)
+        self.assertEqual(execute_code(source, keep_bounds_checks=True),
+                         ('6', []))
+
+        with self.assertRaises(IndexError):
+            parse_file(VALID_PROGRAMS_PATH + 'array_size_index.sym')
+
+    def test_loop_invariant_code_motion(self):
+        source = ('program invariants; int i, n; str s; s = "abc"; n = 5; '
+                  'i = 0; while (i < length(s) - 1) { print(n * 2 + i); '
+                  'i = i + 1; }')
+        program = compile_program(source)
+
+        # length(s) - 1 and n * 2 are computed before the loop's condition
+        opcodes = [quad.split()[0] for quad in program.quadruples]
+        condition = opcodes.index('<')
+        self.assertLess(opcodes.index('length'), condition)
+        self.assertLess(opcodes.index('-'), condition)
+        self.assertLess(opcodes.index('*'), condition)
+        self.assertEqual(run_program(program), ('1011', []))
+
+        # n is never assigned, but the loop never reads it
+        source = ('program unassigned; int i, n, x; i = 5; '
+                  'while (i < 3) { x = n * 2; i = i + 1; } print(i);')
+        self.assertEqual(execute_code(source), ('5', []))
+
+    def test_tail_calls(self):
+        source = ('program tail; '
+                  'fun int sum(int n, int total) { int result; '
+                  'if (n equals 0) { result = total; } '
+                  'else { result = sum(n - 1, total + n); } '
+                  'return result; } '
+                  'print(sum(1000, 0));')
+        opcodes = [quad.split()[0]
+                   for quad in compile_program(source).quadruples]
+        self.assertEqual(opcodes.count('TAILCALL'), 1)
+        self.assertEqual(opcodes.count('GOSUB'), 1)
+
+        # The recursion no longer nests calls
+        for engine in ENGINES:
+            self.assertEqual(execute_code(source, max_call_depth=1,
+                                          engine=engine), ('500500', []))
+
+    def test_string_builders(self):
+        source = ('program builder; str s, t; int i, j; s = ""; t = ""; '
+                  'i = 0; while (i < 3) { j = 0; '
+                  'while (j < i) { s = s + "x"; j = j + 1; } '
+                  's = s + "|"; t = t + "y"; println(t); i = i + 1; } '
+                  'println(s); print(length(s));')
+        opcodes = [quad.split()[0]
+                   for quad in compile_program(source).quadruples]
+
+        # t is printed inside the loop, so only s is built as a list
+        self.assertEqual(opcodes.count('APPEND'), 2)
+        self.assertEqual(opcodes.count('JOIN'), 1)
+        for engine in ENGINES:
+            self.assertEqual(execute_code(source, engine=engine),
+                             ('y\nyy\nyyy\n|x|xx|\n6', []))
+
+    def test_compile_time(self):
+        def many_loops(count):
+            loop = ('i = 0; while (i < 5) {{ t = t + k * 2 + {}; '
+                    's = s + "a"; i = i + 1; }} ')
+            return ('program many; int i, k, t; str s; t = 0; k = 3; '
+                    's = ""; ' + ''.join(map(loop.format, range(count)))
+                    + 'print(t);')
+
+        def compile_time(source):
+            times = []
+            for _ in range(3):
+                start = perf_counter()
+                compile_program(source)
+                times.append(perf_counter() - start)
+            return min(times)
+
+        # Four times the loops take about four times as long (sixteen if the
+        # optimizer were quadratic)
+        ratio = (compile_time(many_loops(200))
+                 / compile_time(many_loops(50)))
+        self.assertLess(ratio, 10)
+
+        source = many_loops(2)
+        with patch('symphony_parser.MAX_OPTIMIZED_QUADRUPLES', 10):
+            self.assertEqual(compile_program(source).quadruples,
+                             compile_program(source,
+                                             optimize=False).quadruples)
+
+
+class ControlFlowTest(TestCase):
+    def test_loops(self):
+        source = ('program loops; int i, j; i = 0; '
+                  'while (i < 3) { j = 0; while (j < i) { ++j; } ++i; } '
+                  'print(i);')
+        program = compile_program(source)
+        quads = [quad.split() for quad in program.quadruples]
+        graph = ControlFlowGraph(quads, program.directory)
+
+        self.assertEqual(len(graph.loops), 2)
+        outer, inner = graph.loops
+        self.assertIs(inner.parent, outer)
+        self.assertEqual(outer.children, [inner])
+        self.assertLess(inner.blocks, outer.blocks)
+
+        # Every loop's header dominates its blocks, and the entry all of them
+        for loop in graph.loops:
+            for block in loop.blocks:
+                self.assertTrue(graph.dominates(loop.header, block))
+                self.assertTrue(graph.dominates(graph.entries[0], block))
+
+        depths = [graph.loop_depth(quad_idx)
+                  for quad_idx in range(len(quads))]
+        self.assertEqual(max(depths), 2)
+        # The print is outside of both loops
+        self.assertEqual(depths[-1], 0)
+
+        for block in graph.blocks:
+            for successor in block.successors:
+                self.assertIn(block.index,
+                              graph.blocks[successor].predecessors)
+
+
+class ProgramCacheTest(TestCase):
+    def test_counters(self):
+        cache = ProgramCache(compile_program, max_size=1)
+        first = 'program first; print(1);'
+        second = 'program second; print(2);'
+
+        program = cache.compile(first)
+        self.assertIs(cache.compile(first), program)
+        cache.compile(second)
+        self.assertIsNot(cache.compile(first), program)
+
+        self.assertEqual(cache.stats(), {'size': 1, 'hits': 1, 'misses': 3,
+                                         'evictions': 2})
+
+    def test_options(self):
+        cache = ProgramCache(compile_program)
+        source = 'program bounds; int a[2]; a[0] = 1; print(a[0]);'
+
+        program = cache.compile(source)
+        checked = cache.compile(source, keep_bounds_checks=True)
+        self.assertIsNot(checked, program)
+        self.assertIs(cache.compile(source, keep_bounds_checks=True), checked)
+        self.assertEqual(checked.quadruples[0].split()[0], 'STORE')
+        self.assertEqual(program.quadruples[0].split()[0], 'STOREU')
+        self.assertEqual(cache.stats()['misses'], 2)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,1210 @@
+"""Optimizations over the quadruples of a finished compilation.
+
+They run between the parser and orchestra and work over the quadruple strings
+(so .note files show the optimized program). Every pass keeps the output of a
+program exactly as it would be without it, errors included: anything that
+could fail is left for the VM to compute.
+"""
+
+from collections import Counter
+from math import copysign
+from Symphony.lexer import Types, OPERATORS
+from Symphony.control_flow import ControlFlowGraph, JUMP_TARGETS
+from Symphony.orchestra import (OPERATIONS, SPECIAL_SIGNATURES,
+                                AddressOverflowError, generate_memory_addresses)
+
+
+# Start and end of the temporal addresses of each type
+TEMPORAL_RANGES = generate_memory_addresses(end_addresses=True).temporal
+
+# Python type of the values stored by each symphony type
+PYTHON_TYPES = {
+    Types.INT : int,
+    Types.CHAR : str,
+    Types.STR : str,
+    Types.BOOL : bool,
+    Types.DEC : float,
+}
+
+# Folded integers and strings bigger than this (in bits or characters) are left
+# for the VM, so a compilation never builds huge constants
+MAX_FOLDED_SIZE = 4096
+MAX_FOLDED_EXPONENT = 1024
+
+# Special functions without side effects, whose calls can be moved out of
+# loops as long as they would run anyway
+PURE_SPECIALS = {'length', 'to_str', 'sqrt', 'log', 'floor', 'ceil', 'get'}
+
+# Operations and special functions which can't fail over initialized operands
+# of the right types, so they can be moved out of loops even if the loops
+# wouldn't have run them
+SAFE_OPERATIONS = set(OPERATIONS) - {'/', 'mod', '**'}
+SAFE_SPECIALS = {'length', 'to_str'}
+
+# Start and end of the addresses of each sector and type
+ADDRESS_RANGES = generate_memory_addresses(end_addresses=True)
+
+# Addresses of the global, temporal and local sectors (the latter belong to
+# the running function's frame)
+GLOBAL_ADDRESSES, TEMPORAL_ADDRESSES, LOCAL_ADDRESSES = (
+    range(min(start for start, _ in sector.values()),
+          max(end for _, end in sector.values()))
+    for sector in (ADDRESS_RANGES.global_, ADDRESS_RANGES.temporal,
+                   ADDRESS_RANGES.local))
+
+# Addresses of the string variables, which loops can build piece by piece
+STRING_ADDRESSES = (range(*ADDRESS_RANGES.global_[Types.STR]),
+                    range(*ADDRESS_RANGES.local[Types.STR]))
+
+# Special functions with effects besides their result (output, input and
+# random numbers). Functions calling them can't be memoized
+EFFECTFUL_SPECIALS = {'print', 'println', 'random', 'input', 'little_star',
+                      'A', 'B', 'C', 'D', 'E', 'F', 'G'}
+
+
+def temporal_type(operand):
+    """ Return the type of a temporal address or None for any other operand """
+    if not operand.isdigit():
+        return None
+
+    address = int(operand)
+    for type_, (start, end) in TEMPORAL_RANGES.items():
+        if start <= address < end:
+            return type_
+
+    return None
+
+
+def operand_roles(quad):
+    """Return the positions of the addresses a quadruple reads and writes
+
+    Positions count the operator. Array elements aren't included, only the
+    offsets and values used to reach them
+    """
+    opcode = quad[0]
+
+    if opcode in OPERATORS:
+        return (1, 2), (3,)
+    elif opcode in OPERATIONS:
+        return (1,), (2,)
+    elif opcode in ('PARAM', 'GOTOF'):
+        return (1,), ()
+    elif opcode == 'LOAD':
+        return (2,), (4,)
+    elif opcode == 'STORE':
+        return (1, 3), ()
+    elif opcode == 'LOADU':
+        return (2,), (3,)
+    elif opcode == 'STOREU':
+        return (1, 3), ()
+    elif opcode == 'APPEND':
+        return (1, 2), (2,)
+    elif opcode == 'JOIN':
+        return (1,), (1,)
+    elif opcode in SPECIAL_SIGNATURES and len(quad) == 2:
+        # Special functions with a result receive its address
+        return (), (1,)
+
+    return (), ()
+
+
+def reads_address(quad, address):
+    """ Check if a quadruple reads an address """
+    reads, _ = operand_roles(quad)
+    return any(quad[position] == address for position in reads)
+
+
+def writes_address(quad, address):
+    """ Check if a quadruple writes an address """
+    _, writes = operand_roles(quad)
+    return any(quad[position] == address for position in writes)
+
+
+def substitute(quad, replacements):
+    """ Replace the addresses read by a quadruple """
+    for position in operand_roles(quad)[0]:
+        quad[position] = replacements.get(quad[position], quad[position])
+
+
+def fold(opcode, values, result_type):
+    """Compute an operation at compile time
+
+    None is returned when the operation has to be left for the VM, either
+    because it fails (the VM gives the proper error message), because its
+    result can't be stored as a constant of its type or because it's too big
+    """
+    if opcode == '**' and abs(values[1]) > MAX_FOLDED_EXPONENT:
+        return None
+
+    try:
+        value = OPERATIONS[opcode](*values)
+    except (ArithmeticError, ValueError):
+        return None
+
+    # Constants are kept by value, so 1 and 1.0 or 0.0 and -0.0 share their
+    # address. Only values that can't be confused with another are folded
+    if type(value) is not PYTHON_TYPES[result_type]:
+        return None
+    if isinstance(value, float) and value == 0 and copysign(1, value) < 0:
+        return None
+
+    if isinstance(value, str):
+        size = len(value)
+    elif isinstance(value, int):
+        size = value.bit_length()
+    else:
+        size = 0
+
+    if size > MAX_FOLDED_SIZE:
+        return None
+
+    return value
+
+
+def fold_constants(quads, quadruple_generator, directory):
+    """Replace operations over constants with their result
+
+    Each folded quadruple is removed and its temporal is replaced with a new
+    constant in the quadruples reading it. Conditional jumps over constants
+    are resolved too. Returns the indices of the removed quadruples
+    """
+    constants = quadruple_generator.constant_table()
+    removed = set()
+
+    definitions = Counter(quad[position] for quad in quads
+                          for position in operand_roles(quad)[1])
+    return_addresses = {str(function.return_address)
+                        for function in directory.functions.values()}
+
+    def is_constant(operand):
+        return operand.isdigit() and int(operand) in constants
+
+    # Temporals holding a folded value until they are written again, and those
+    # which are never written again
+    known = {}
+    single_definition = {}
+
+    for quad_idx, quad in enumerate(quads):
+        reads, writes = operand_roles(quad)
+
+        substitute(quad, known)
+        for position in writes:
+            known.pop(quad[position], None)
+
+        opcode = quad[0]
+        if opcode == 'GOTOF' and is_constant(quad[1]):
+            # A constant condition either never jumps or always does
+            if constants[int(quad[1])]:
+                removed.add(quad_idx)
+            else:
+                quad[:] = ['GOTO', quad[2]]
+            continue
+
+        if opcode not in OPERATIONS or not all(is_constant(quad[position])
+                                               for position in reads):
+            continue
+
+        result = quad[writes[0]]
+        result_type = temporal_type(result)
+        if (result_type is None
+          or (result in return_addresses and definitions[result] > 1)):
+            continue
+
+        value = fold(opcode, [constants[int(quad[position])]
+                              for position in reads], result_type)
+        if value is None:
+            continue
+
+        try:
+            address = quadruple_generator.constant_address(result_type, value)
+        except AddressOverflowError:
+            # The program already uses every constant address of this type
+            continue
+
+        constants[address] = value
+        known[result] = str(address)
+        if definitions[result] == 1:
+            single_definition[result] = str(address)
+        removed.add(quad_idx)
+
+    # A temporal written once has the same value everywhere, even when it's
+    # read before its definition (calls to a function whose return is after
+    # them). The functions returning it now return the constant
+    for quad in quads:
+        substitute(quad, single_definition)
+
+    for function in directory.functions.values():
+        return_address = str(function.return_address)
+        if return_address in single_definition:
+            function.return_address = int(single_definition[return_address])
+
+    return removed
+
+
+def reachable_quads(quads, removed, directory):
+    """ Return the indices of the quadruples the program can ever run """
+    reachable = set()
+    pending = [0]
+
+    while pending:
+        quad_idx = pending.pop()
+        if quad_idx in reachable or quad_idx >= len(quads):
+            continue
+        reachable.add(quad_idx)
+
+        quad = quads[quad_idx]
+        opcode = quad[0]
+        if quad_idx in removed:
+            pending.append(quad_idx + 1)
+        elif opcode == 'GOTO':
+            pending.append(int(quad[1]))
+        elif opcode == 'GOTOF':
+            pending.extend((quad_idx + 1, int(quad[2])))
+        elif opcode == 'GOSUB':
+            # Calls come back to the quadruple after them
+            pending.extend((quad_idx + 1,
+                            directory.functions[quad[1]].starting_quad))
+        elif opcode == 'TAILCALL':
+            pending.append(directory.functions[quad[1]].starting_quad)
+        elif opcode != 'ENDPROC':
+            pending.append(quad_idx + 1)
+
+    return reachable
+
+
+def retarget(quads, new_index, directory):
+    """Point every jump and function start to where its target moved
+
+    new_index receives a target and the index of the jump going to it (None
+    for function starts) and returns the target's new index
+    """
+    for quad_idx, quad in enumerate(quads):
+        if quad[0] in JUMP_TARGETS:
+            position = JUMP_TARGETS[quad[0]]
+            quad[position] = str(new_index(int(quad[position]), quad_idx))
+
+    for function in directory.functions.values():
+        function.starting_quad = new_index(function.starting_quad, None)
+        if function.first_quadruple is not None:
+            function.first_quadruple = new_index(function.first_quadruple,
+                                                 None)
+
+
+def remove_quads(quads, kept, directory):
+    """Keep some quadruples, fixing every jump and function start
+
+    A jump to a quadruple that was removed goes to the next one kept, which is
+    where the removed quadruple would have led
+    """
+    new_indices = []
+    kept_count = 0
+    for quad_idx in range(len(quads) + 1):
+        new_indices.append(kept_count)
+        if quad_idx in kept:
+            kept_count += 1
+
+    retarget(quads, lambda target, _: new_indices[target], directory)
+    return [quad for quad_idx, quad in enumerate(quads) if quad_idx in kept]
+
+
+def collapse_jump_chains(quads):
+    """ Make every jump to a GOTO go directly to the GOTO's target """
+    for quad in quads:
+        if quad[0] not in JUMP_TARGETS:
+            continue
+
+        position = JUMP_TARGETS[quad[0]]
+        target = int(quad[position])
+        visited = set()
+        while (target < len(quads) and quads[target][0] == 'GOTO'
+          and target not in visited):
+            # An endless chain of GOTOs is left as it is
+            visited.add(target)
+            target = int(quads[target][1])
+
+        quad[position] = str(target)
+
+
+def redundant_jumps(quads):
+    """Return the jumps to the quadruple right after them
+
+    Conditional jumps are only redundant if their condition can't fail to be
+    read, which is the case for constants and temporals (they are always
+    written before being read)
+    """
+    redundant = set()
+    for quad_idx, quad in enumerate(quads):
+        if quad[0] not in JUMP_TARGETS:
+            continue
+        if int(quad[JUMP_TARGETS[quad[0]]]) != quad_idx + 1:
+            continue
+
+        if quad[0] == 'GOTO' or temporal_type(quad[1]) is not None:
+            redundant.add(quad_idx)
+
+    return redundant
+
+
+def fuse_moves(quads, directory):
+    """Make quadruples write directly to the variable they are assigned to
+
+    'op a b t' followed by '= t v' becomes 'op a b v' when t is a temporal
+    that is not read again before being rewritten. Both quadruples must be in
+    the same basic block, so that they always run together. Moves of a value
+    to its own address are removed too. Returns the removed moves
+    """
+    graph = ControlFlowGraph(quads, directory)
+    return_addresses = {str(function.return_address)
+                        for function in directory.functions.values()}
+
+    def is_read_later(temporal, quad_idx):
+        for quad in quads[quad_idx + 1:]:
+            if reads_address(quad, temporal):
+                return True
+            _, writes = operand_roles(quad)
+            if any(quad[position] == temporal for position in writes):
+                return False
+        return False
+
+    removed = set()
+    for quad_idx, quad in enumerate(quads[1:], start=1):
+        if quad[0] != '=':
+            continue
+
+        source, destination = quad[1], quad[2]
+        previous = quads[quad_idx - 1]
+        _, writes = operand_roles(previous)
+        together = graph.block_of(quad_idx).start != quad_idx
+
+        if source == destination:
+            # A variable may still be unassigned, and reading it must fail
+            if (temporal_type(source) is not None or (together and any(
+              previous[position] == source for position in writes))):
+                removed.add(quad_idx)
+            continue
+
+        if (not together or temporal_type(source) is None
+          or source in return_addresses or writes != (len(previous) - 1,)
+          or previous[-1] != source
+          or quad_idx - 1 in removed or is_read_later(source, quad_idx)):
+            continue
+
+        previous[-1] = destination
+        removed.add(quad_idx)
+
+    return removed
+
+
+def peephole(quads, directory):
+    """Collapse jump chains, remove jumps to the next quadruple and fuse
+    operations with the moves after them, until nothing changes
+    """
+    while True:
+        collapse_jump_chains(quads)
+        removed = redundant_jumps(quads) | fuse_moves(quads, directory)
+        kept = reachable_quads(quads, removed, directory) - removed
+        if len(kept) == len(quads):
+            return quads
+
+        quads = remove_quads(quads, kept, directory)
+
+
+def returns_call_result(quads, quad_idx, function):
+    """Check if a function returns right after a call to itself
+
+    From the quadruple after the call, the function can only copy the call's
+    result (found in its return address) into its frame and jump, until it
+    reaches its ENDPROC with the result in its return address
+    """
+    return_address = str(function.return_address)
+    holding_result = {return_address}
+    visited = set()
+
+    while quad_idx < len(quads) and quad_idx not in visited:
+        visited.add(quad_idx)
+        quad = quads[quad_idx]
+
+        if quad[0] == 'GOTO':
+            quad_idx = int(quad[1])
+            continue
+        elif quad[0] == 'ENDPROC':
+            return (quad[1] == function.name
+                    and return_address in holding_result)
+
+        if (quad[0] != '=' or quad[1] not in holding_result
+          or int(quad[2]) not in LOCAL_ADDRESSES):
+            return False
+
+        holding_result.add(quad[2])
+        quad_idx += 1
+
+    return False
+
+
+def tail_calls(quads, directory):
+    """Turn the recursive calls whose result is returned right away into
+    TAILCALLs
+
+    The callee then replaces the caller's frame and returns its result
+    directly to the caller's caller, so tail recursion runs in constant space.
+    The quadruples after the call can't run anymore and are left for the
+    peephole stage to remove
+    """
+    for quad_idx, quad in enumerate(quads):
+        if quad[0] == 'GOSUB' and returns_call_result(
+          quads, quad_idx + 1, directory.functions[quad[1]]):
+            quad[0] = 'TAILCALL'
+
+
+def constant_index_accesses(quads, constants):
+    """Remove the bounds checks of accesses to constant indices within their
+    array
+
+    Indices out of bounds keep their runtime check, which gives the proper
+    error
+    """
+    for quad in quads:
+        if quad[0] == 'LOAD':
+            base, offset, size, result = quad[1:]
+        elif quad[0] == 'STORE':
+            value, base, offset, size = quad[1:]
+        else:
+            continue
+
+        index = constants.get(int(offset)) if offset.isdigit() else None
+        if type(index) is not int or not 0 <= index < int(size):
+            continue
+
+        if quad[0] == 'LOAD':
+            quad[:] = ['LOADU', base, offset, result]
+        else:
+            quad[:] = ['STOREU', value, base, offset]
+
+
+def counting_loop_accesses(quads, constants, directory):
+    """Remove the bounds checks of accesses indexed by a counting loop's
+    variable
+
+    The loops handled look like 'i = c; while (i < k) {...}', where c and k
+    are integer constants, c isn't negative and the body only adds constants
+    that aren't negative to i. An access a[i] in the body that comes before
+    any of those additions (and isn't inside an inner loop) is within bounds
+    if k isn't bigger than a's size, so it becomes a LOADU or STOREU
+    """
+    graph = ControlFlowGraph(quads, directory)
+
+    def constant_int(operand):
+        value = constants.get(int(operand)) if operand.isdigit() else None
+        return value if type(value) is int else None
+
+    for loop in graph.loops:
+        # Only innermost loops whose quadruples are all together, from the
+        # header to the jump back to it
+        header = graph.blocks[loop.header].start
+        back_jump = max(graph.blocks[block].end for block in loop.blocks) - 1
+        loop_size = sum(len(graph.blocks[block].quad_indices())
+                        for block in loop.blocks)
+        if (loop.children or loop_size != back_jump - header + 1
+          or quads[back_jump] != ['GOTO', str(header)]
+          or header < 1 or header + 1 >= back_jump):
+            continue
+
+        # The loop must also be entered right after its initialization
+        if any(predecessor not in loop.blocks
+               and graph.blocks[predecessor].end != header
+               for predecessor in graph.blocks[loop.header].predecessors):
+            continue
+
+        initialization, comparison, exit_jump = quads[header - 1:header + 2]
+        if (comparison[0] != '<' or exit_jump[:2] != ['GOTOF', comparison[3]]
+          or int(exit_jump[2]) != back_jump + 1):
+            continue
+
+        variable, limit = comparison[1], constant_int(comparison[2])
+        if (limit is None or temporal_type(variable) is not None
+          or initialization[0] != '=' or initialization[2] != variable
+          or constant_int(initialization[1]) is None
+          or constant_int(initialization[1]) < 0):
+            continue
+
+        body = range(header + 2, back_jump)
+        if not is_counting_body(quads, body, variable, constant_int):
+            continue
+
+        for quad_idx in body:
+            body_quad = quads[quad_idx]
+            _, writes = operand_roles(body_quad)
+            if any(body_quad[position] == variable for position in writes):
+                # Every access after the first addition may be out of bounds
+                break
+
+            if body_quad[0] == 'LOAD':
+                base, offset, size, result = body_quad[1:]
+                if offset == variable and limit <= int(size):
+                    body_quad[:] = ['LOADU', base, offset, result]
+            elif body_quad[0] == 'STORE':
+                value, base, offset, size = body_quad[1:]
+                if offset == variable and limit <= int(size):
+                    body_quad[:] = ['STOREU', value, base, offset]
+
+
+def is_counting_body(quads, body, variable, constant_int):
+    """Check if a loop's body only counts up its variable
+
+    The body can't call functions when the variable is global (they could
+    change it)
+    """
+    is_global = int(variable) < TEMPORAL_RANGES[Types.INT][0]
+
+    for quad_idx in body:
+        quad = quads[quad_idx]
+
+        if quad[0] == 'GOSUB' and is_global:
+            return False
+
+        _, writes = operand_roles(quad)
+        if not any(quad[position] == variable for position in writes):
+            continue
+
+        if quad[0] == '++' and quad[1] == variable:
+            continue
+        if quad[0] == '+' and variable in quad[1:3]:
+            other = quad[2] if quad[1] == variable else quad[1]
+            if constant_int(other) is not None and constant_int(other) >= 0:
+                continue
+
+        return False
+
+    return True
+
+
+def eliminate_bounds_checks(quads, quadruple_generator, directory):
+    """ Remove the runtime checks of array accesses that are always valid """
+    constants = quadruple_generator.constant_table()
+
+    constant_index_accesses(quads, constants)
+    counting_loop_accesses(quads, constants, directory)
+
+
+def live_temporals(graph):
+    """Return the temporals that may be read after each block before being
+    written
+    """
+    uses = []
+    definitions = []
+    for block in graph.blocks:
+        used = set()
+        defined = set()
+        for quad in graph.quads[block.start:block.end]:
+            reads, writes = operand_roles(quad)
+            used.update(quad[position] for position in reads
+                        if quad[position] not in defined
+                        and temporal_type(quad[position]) is not None)
+            defined.update(quad[position] for position in writes
+                           if temporal_type(quad[position]) is not None)
+        uses.append(used)
+        definitions.append(defined)
+
+    live_in = [set() for _ in graph.blocks]
+    live_out = [set() for _ in graph.blocks]
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(graph.blocks):
+            live_out[block.index] = set().union(
+                *(live_in[successor] for successor in block.successors))
+            new_live_in = uses[block.index] | (live_out[block.index]
+                                               - definitions[block.index])
+            if new_live_in != live_in[block.index]:
+                live_in[block.index] = new_live_in
+                changed = True
+
+    return live_out
+
+
+def assigned_addresses(graph, directory):
+    """Return the addresses surely written before each block runs
+
+    Functions start with their parameters assigned and the program with
+    nothing. Blocks that can't be reached get None
+    """
+    parameters = {}
+    for function in directory.functions.values():
+        if function.starting_quad < len(graph.quads):
+            entry = graph.block_at[function.starting_quad]
+            parameters[entry] = {str(address) for address
+                                 in function.parameter_addresses}
+
+    writes = [{quad[position] for quad in graph.quads[block.start:block.end]
+               for position in operand_roles(quad)[1]}
+              for block in graph.blocks]
+
+    # None stands for every address until a block is reached
+    assigned = [None] * len(graph.blocks)
+    order = graph.reachable_blocks()
+    changed = True
+    while changed:
+        changed = False
+        for block in order:
+            incoming = [parameters[block]] if block in parameters else []
+            incoming.extend(assigned[predecessor] | writes[predecessor]
+                            for predecessor
+                            in graph.blocks[block].predecessors
+                            if assigned[predecessor] is not None)
+
+            new_assigned = set.intersection(*incoming)
+            if new_assigned != assigned[block]:
+                assigned[block] = new_assigned
+                changed = True
+
+    return assigned
+
+
+class LoopHoister():
+    """Find the invariant computations of a loop that can run before it
+
+    Computations at the start of the loop's header (the ones before its first
+    computation that isn't invariant) always run when the loop is entered, so
+    any pure operation or special call is moved. Anywhere else in the loop,
+    only the ones that can't fail are moved, and only if the variables they
+    read are surely assigned (running them before the loop must not raise any
+    error).
+
+    A temporal reused for other values inside the loop gets a new address
+    when its computation is moved, unless it's live after its block
+    """
+    def __init__(self, quads, graph, loop, quadruple_generator,
+                 return_addresses, assigned, live_out):
+        self.quads = quads
+        self.graph = graph
+        self.loop = loop
+        self.quadruple_generator = quadruple_generator
+        self.constants = quadruple_generator.constant_table()
+        self.return_addresses = return_addresses
+        self.assigned = set(assigned[loop.header] or ())
+        self.live_out = live_out
+        self.hoisted = []
+
+        self.loop_quads = sorted(quad_idx for block in loop.blocks for quad_idx
+                                 in graph.blocks[block].quad_indices())
+        self.written = Counter()
+        for quad_idx in self.loop_quads:
+            self.add_writes(quads[quad_idx])
+
+
+    def add_writes(self, quad):
+        """Count the addresses a quadruple writes
+
+        Array elements are only read through LOADs, which are never moved, so
+        stores don't count
+        """
+        self.written.update(quad[position]
+                            for position in operand_roles(quad)[1])
+
+        if quad[0] == 'copy':
+            # copy writes to the address of its first argument
+            self.written.update(self.quads[quad_idx][1]
+                                for quad_idx in self.loop_quads
+                                if self.quads[quad_idx][0] == 'PARAM')
+
+
+    def is_invariant(self, operand):
+        """ Check if the loop can't change an address """
+        if int(operand) in self.constants:
+            return True
+
+        return self.written[operand] == 0
+
+
+    def is_assigned(self, operand):
+        """ Check if reading an address before the loop can't fail """
+        return (int(operand) in self.constants
+                or temporal_type(operand) is not None
+                or operand in self.assigned)
+
+
+    def unit(self, quad_idx, end, specials, operations):
+        """Return the quadruples of a computation starting at a quadruple
+
+        A computation is an operation or a call to a special function with its
+        PARAMs. The addresses it reads and the position of its result are
+        returned too. None is returned if it isn't a computation of the
+        allowed ones
+        """
+        quad = self.quads[quad_idx]
+        if quad[0] in operations:
+            reads, writes = operand_roles(quad)
+            return ([quad_idx], [quad[position] for position in reads],
+                    writes[0])
+        elif quad[0] != 'PARAM':
+            return None
+
+        call_idx = quad_idx
+        while call_idx < end and self.quads[call_idx][0] == 'PARAM':
+            call_idx += 1
+
+        if (call_idx == end or self.quads[call_idx][0] not in specials
+          or len(self.quads[call_idx]) != 2):
+            return None
+
+        return (list(range(quad_idx, call_idx + 1)),
+                [self.quads[param_idx][1]
+                 for param_idx in range(quad_idx, call_idx)], 1)
+
+
+    def dominates_reads(self, quad_idx, address):
+        """ Check if a quadruple runs before every read of an address """
+        block = self.graph.block_at[quad_idx]
+
+        for read_idx in self.loop_quads:
+            if not reads_address(self.quads[read_idx], address):
+                continue
+
+            read_block = self.graph.block_at[read_idx]
+            if read_block == block:
+                if read_idx <= quad_idx:
+                    return False
+            elif not self.graph.dominates(block, read_block):
+                return False
+
+        return True
+
+
+    def rename_result(self, quad_idx, position):
+        """Give the result of a quadruple a new temporal address
+
+        The quadruples reading it up to its next definition in the same block
+        read the new address instead. Returns False if the old address may be
+        read after the block, where it can't be renamed
+        """
+        result = self.quads[quad_idx][position]
+        block = self.graph.block_of(quad_idx)
+
+        uses = []
+        for use_idx in range(quad_idx + 1, block.end):
+            if reads_address(self.quads[use_idx], result):
+                uses.append(use_idx)
+            if writes_address(self.quads[use_idx], result):
+                break
+        else:
+            if result in self.live_out[block.index]:
+                return False
+
+        try:
+            new_result = self.quadruple_generator.generate_temporal_address(
+                temporal_type(result))
+        except AddressOverflowError:
+            return False
+
+        new_result = str(new_result)
+        self.quads[quad_idx][position] = new_result
+        for use_idx in uses:
+            substitute(self.quads[use_idx], {result: new_result})
+
+        return True
+
+
+    def hoist(self, unit, always_runs):
+        """ Move a computation before the loop if it's invariant """
+        indices, reads, position = unit
+        last_idx = indices[-1]
+        result = self.quads[last_idx][position]
+
+        if (not all(self.is_invariant(operand) for operand in reads)
+          or result in self.return_addresses):
+            return False
+
+        if (always_runs and self.written[result] == 1
+          and self.dominates_reads(last_idx, result)):
+            # Its value is the same the loop would have left in it
+            self.written[result] -= 1
+        elif (temporal_type(result) is not None
+          and self.rename_result(last_idx, position)):
+            self.written[result] -= 1
+        else:
+            return False
+
+        self.hoisted.extend(indices)
+        return True
+
+
+    def find_invariants(self):
+        """ Return the quadruples (indices) that can run before the loop """
+        header = self.graph.blocks[self.loop.header]
+        if (any(self.quads[quad_idx][0] == 'GOSUB'
+                for quad_idx in self.loop_quads)
+          or self.loop_quads[0] != header.start
+          or (header.start > 0
+              and self.graph.block_at[header.start - 1] in self.loop.blocks)):
+            # Functions could change any address, and the loop must be
+            # entered from outside of it through the start of its header
+            return []
+
+        quad_idx = header.start
+        while quad_idx < header.end:
+            unit = self.unit(quad_idx, header.end, PURE_SPECIALS, OPERATIONS)
+            if unit is None or not self.hoist(unit, always_runs=True):
+                break
+
+            self.assigned.update(unit[1])
+            quad_idx = unit[0][-1] + 1
+
+        for block in sorted(self.loop.blocks - {self.loop.header}):
+            block = self.graph.blocks[block]
+            quad_idx = block.start
+            while quad_idx < block.end:
+                unit = self.unit(quad_idx, block.end, SAFE_SPECIALS,
+                                 SAFE_OPERATIONS)
+                if unit is None:
+                    quad_idx += 1
+                    continue
+
+                if all(self.is_assigned(operand) for operand in unit[1]):
+                    self.hoist(unit, always_runs=False)
+                quad_idx = unit[0][-1] + 1
+
+        return self.hoisted
+
+
+def move_before_loops(quads, moves, directory):
+    """Move quadruples right before the loops holding them, where they run
+    once
+
+    moves maps the start of each loop (its first quadruple) to the indices of
+    the loop's quadruples and of the ones moved. Jumps from outside of a loop
+    to its start now go to the moved quadruples, and the ones from inside
+    (which repeat the loop) skip them
+    """
+    hoisted_set = {quad_idx for _, hoisted in moves.values()
+                   for quad_idx in hoisted}
+    order = []
+    # Index where the quadruples moved before each loop start
+    starts = {}
+    for quad_idx in range(len(quads)):
+        if quad_idx in moves:
+            starts[quad_idx] = len(order)
+            order.extend(moves[quad_idx][1])
+        if quad_idx not in hoisted_set:
+            order.append(quad_idx)
+
+    new_indices = {quad_idx: new_idx for new_idx, quad_idx in enumerate(order)}
+    new_indices[len(quads)] = len(quads)
+    inside = {start: set(loop_quads)
+              for start, (loop_quads, _) in moves.items()}
+
+    def new_target(target, quad_idx):
+        if target in starts and quad_idx not in inside[target]:
+            return starts[target]
+        # A moved quadruple is replaced by the next one still in the loop
+        while target in hoisted_set:
+            target += 1
+        return new_indices[target]
+
+    retarget(quads, new_target, directory)
+    return [quads[quad_idx] for quad_idx in order]
+
+
+def loop_invariant_code_motion(quads, quadruple_generator, directory):
+    """Move the computations of loops that give the same value in every
+    iteration right before the loops, innermost loops first
+
+    Every round analyses the loops of a single graph and moves the
+    computations of all of them at once. A loop containing one that changed
+    is left for the next round, which sees the computations moved into it.
+    Loops calling functions are left as they are. Returns the new quadruples
+    """
+    return_addresses = {str(function.return_address)
+                        for function in directory.functions.values()}
+    # Temporals renamed by the hoister must be new ones, not released ones
+    quadruple_generator.reset_temporal_pool()
+
+    while True:
+        graph = ControlFlowGraph(quads, directory)
+        assigned = assigned_addresses(graph, directory)
+        live_out = live_temporals(graph)
+        moves = {}
+        changed_blocks = set()
+
+        for loop in sorted(graph.loops, key=lambda loop: loop.depth(),
+                           reverse=True):
+            if loop.blocks & changed_blocks:
+                continue
+
+            hoister = LoopHoister(quads, graph, loop, quadruple_generator,
+                                  return_addresses, assigned, live_out)
+            hoisted = hoister.find_invariants()
+            if hoisted:
+                moves[hoister.loop_quads[0]] = (hoister.loop_quads, hoisted)
+                changed_blocks |= loop.blocks
+
+        if not moves:
+            return quads
+        quads = move_before_loops(quads, moves, directory)
+
+
+def loop_appends(quads, graph, loop):
+    """Return the strings a loop only appends to ('+ s x s') and the indices
+    of the quadruples appending to each one
+
+    Functions called by the loop could read global strings, so only local
+    ones are returned for loops with calls
+    """
+    loop_quads = [quad_idx for block in loop.blocks
+                  for quad_idx in graph.blocks[block].quad_indices()]
+    calls = any(quads[quad_idx][0] in ('GOSUB', 'TAILCALL')
+                for quad_idx in loop_quads)
+
+    appends = {}
+    used = set()
+    for quad_idx in loop_quads:
+        quad = quads[quad_idx]
+        if quad[0] == '+' and quad[1] == quad[3] != quad[2]:
+            appends.setdefault(quad[1], []).append(quad_idx)
+            used.add(quad[2])
+        else:
+            reads, writes = operand_roles(quad)
+            used.update(quad[position] for position in reads + writes)
+
+    return {string: indices for string, indices in appends.items()
+            if string not in used
+            and any(int(string) in addresses for addresses in STRING_ADDRESSES)
+            and (not calls or int(string) in LOCAL_ADDRESSES)}
+
+
+def insert_quads(quads, insertions, directory):
+    """Insert quadruples before some indices
+
+    insertions maps each index to the quadruples inserted before it. Jumps
+    to an index run its inserted quadruples first. Returns the new quadruples
+    """
+    new_quads = []
+    new_indices = {}
+    for quad_idx, quad in enumerate(quads):
+        new_indices[quad_idx] = len(new_quads)
+        new_quads.extend(insertions.get(quad_idx, []))
+        new_quads.append(quad)
+    new_indices[len(quads)] = len(new_quads)
+
+    retarget(quads, lambda target, _: new_indices[target], directory)
+    return new_quads
+
+
+def string_builders(quads, directory):
+    """Build the strings loops only append to as lists of pieces
+
+    'APPEND x s' adds a piece to s and 'JOIN s', inserted wherever the loop
+    may exit to, turns the pieces back into a string, so building a string of
+    n characters takes O(n) instead of O(n²). Outermost loops are handled
+    first, all of them from the same graph. A loop overlapping one already
+    rewritten (or the exits where its JOINs go) is left for a new graph,
+    which is only built in that case. Returns the new quadruples
+    """
+    while True:
+        graph = ControlFlowGraph(quads, directory)
+        insertions = {}
+        changed_blocks = set()
+        deferred = False
+
+        for loop in graph.loops:
+            appends = loop_appends(quads, graph, loop)
+            if not appends:
+                continue
+
+            exits = {successor for block in loop.blocks
+                     for successor in graph.blocks[block].successors
+                     if successor not in loop.blocks}
+            if (loop.blocks | exits) & changed_blocks:
+                deferred = True
+                continue
+            changed_blocks |= loop.blocks | exits
+
+            for string, indices in appends.items():
+                for quad_idx in indices:
+                    quads[quad_idx] = ['APPEND', quads[quad_idx][2], string]
+
+            for exit_block in exits:
+                joins = insertions.setdefault(graph.blocks[exit_block].start,
+                                              [])
+                joins.extend(['JOIN', string] for string in sorted(appends))
+
+        quads = insert_quads(quads, insertions, directory)
+        if not deferred:
+            return quads
+
+
+def call_roles(quad, directory):
+    """Return the addresses a quadruple reads and writes
+
+    Calls count as writing their function's return address and ENDPROC as
+    reading it, since that's where the result goes from one to the other
+    """
+    if quad[0] == 'GOSUB':
+        return (), (str(directory.functions[quad[1]].return_address),)
+    elif quad[0] == 'ENDPROC':
+        return (str(directory.functions[quad[1]].return_address),), ()
+
+    reads, writes = operand_roles(quad)
+    return ([quad[position] for position in reads],
+            [quad[position] for position in writes])
+
+
+def read_before_written(graph, blocks, address, directory):
+    """ Check if an address may be read from blocks before being written """
+    pending = list(blocks)
+    visited = set()
+
+    while pending:
+        block = graph.blocks[pending.pop()]
+        if block.index in visited:
+            continue
+        visited.add(block.index)
+
+        for quad in graph.quads[block.start:block.end]:
+            reads, writes = call_roles(quad, directory)
+            if address in reads:
+                return True
+            if address in writes:
+                break
+        else:
+            pending.extend(block.successors)
+
+    return False
+
+
+def function_blocks(graph, function):
+    """ Return the blocks a function may run, starting with its first one """
+    entry = graph.block_at[function.starting_quad]
+    blocks = [entry]
+    for block in blocks:
+        blocks.extend(successor for successor
+                      in graph.blocks[block].successors
+                      if successor not in blocks)
+
+    return blocks
+
+
+def function_calls(graph, blocks):
+    """ Return the blocks ending in a call and the names of their callees """
+    calls = {}
+    for block in blocks:
+        last = graph.quads[graph.blocks[block].end - 1]
+        if last[0] in ('GOSUB', 'TAILCALL'):
+            calls[block] = last[1]
+
+    return calls
+
+
+def is_self_contained(graph, blocks, directory):
+    """Check if a function's blocks only use its arguments and own variables
+
+    They can't call effectful special functions nor touch global variables
+    or arrays, and their temporals (global memory too) must be written before
+    being read. Returns the temporals they use or None if they aren't
+    """
+    temporals = set()
+    for block in blocks:
+        for quad in graph.quads[graph.blocks[block].start:
+                                graph.blocks[block].end]:
+            if quad[0] in EFFECTFUL_SPECIALS:
+                return None
+            elif quad[0] in ('GOSUB', 'TAILCALL'):
+                continue
+
+            reads, writes = call_roles(quad, directory)
+            addresses = [int(address) for address in (*reads, *writes)]
+            if quad[0] in ('LOAD', 'LOADU'):
+                addresses.append(int(quad[1]))
+            elif quad[0] in ('STORE', 'STOREU'):
+                addresses.append(int(quad[2]))
+
+            if any(address in GLOBAL_ADDRESSES for address in addresses):
+                return None
+            temporals.update(str(address) for address in addresses
+                             if address in TEMPORAL_ADDRESSES)
+
+    if any(read_before_written(graph, blocks[:1], temporal, directory)
+           for temporal in temporals):
+        return None
+    return temporals
+
+
+def mark_pure_functions(quadruples, directory):
+    """Mark the functions whose calls the VM can memoize
+
+    A pure function returns a value that depends only on its arguments (which
+    are never arrays) and has no other effect, and so do the functions it
+    calls. Its temporals can't be read after a call that may run the function
+    again, since that call writes them too
+    """
+    quads = [quad.split() for quad in quadruples]
+    graph = ControlFlowGraph(quads, directory)
+
+    candidates = {}
+    for name, function in directory.functions.items():
+        function.pure = False
+        if (name == directory.GLOBAL_SCOPE or function.return_address is None
+          or function.starting_quad >= len(quads)):
+            continue
+
+        blocks = function_blocks(graph, function)
+        temporals = is_self_contained(graph, blocks, directory)
+        if temporals is not None:
+            candidates[name] = (blocks, temporals,
+                                function_calls(graph, blocks))
+
+    changed = True
+    while changed:
+        changed = False
+        for name, (_, _, calls) in list(candidates.items()):
+            if not set(calls.values()) <= candidates.keys():
+                del candidates[name]
+                changed = True
+
+    # Functions that may run while each function is being called
+    reached = {}
+    for name, (_, _, calls) in candidates.items():
+        reached[name] = set()
+        pending = list(calls.values())
+        while pending:
+            callee = pending.pop()
+            if callee not in reached[name]:
+                reached[name].add(callee)
+                pending.extend(candidates[callee][2].values())
+
+    for name, (blocks, temporals, calls) in candidates.items():
+        reentrant = [block for block, callee in calls.items()
+                     if name in reached[callee] | {callee}]
+        if not any(read_before_written(graph, graph.blocks[block].successors,
+                                       temporal, directory)
+                   for block in reentrant for temporal in temporals):
+            directory.functions[name].pure = True
+
+
+def optimize_quadruples(quadruples, quadruple_generator, directory,
+                        keep_bounds_checks=False):
+    """Fold constant expressions, remove the quadruples that never run and
+    simplify what is left with a peephole stage
+
+    New constants are registered in the quadruple generator and the starting
+    quadruples in the directory are updated. Recursive calls in tail position
+    become TAILCALLs. Array accesses that are always within bounds lose their
+    runtime check, unless all of them must be kept. Then, invariant
+    computations are moved out of loops and the strings loops only append to
+    are built as lists. Returns the new quadruples
+    """
+    quads = [quad.split() for quad in quadruples]
+
+    removed = fold_constants(quads, quadruple_generator, directory)
+    kept = reachable_quads(quads, removed, directory) - removed
+    quads = remove_quads(quads, kept, directory)
+    tail_calls(quads, directory)
+    quads = peephole(quads, directory)
+
+    if not keep_bounds_checks:
+        eliminate_bounds_checks(quads, quadruple_generator, directory)
+        quads = peephole(quads, directory)
+
+    quads = loop_invariant_code_motion(quads, quadruple_generator, directory)
+    quads = string_builders(quads, directory)
+
+    return [' '.join(quad) for quad in quads]
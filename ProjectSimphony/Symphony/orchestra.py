@@ -1,11 +1,13 @@
+from array import array
 from collections import namedtuple
-from copy import deepcopy
-from functools import partial
-from Symphony.lexer import Types, DUPLICATED_OPERATORS
-from math import sqrt, log, floor, ceil
+from functools import partial, reduce
+from Symphony.lexer import Types, OPERATORS, DUPLICATED_OPERATORS
+from math import sqrt, log, floor, ceil, gcd
 from random import random
+from time import monotonic
 from operator import (add, sub, mul, truediv, mod, eq, gt, lt, ge, le, and_,
                       or_, pos, neg, not_)
+from Symphony.output_sinks import BufferedOutput
 
 
 # Local memory sector declaration
@@ -17,19 +19,21 @@ MEMORY_SECTORS = (
     ('end', 350_000),
 )
 
-# Actual runtime memory. It has a type dictionary for each sector
-memory = {sector[0]: {type_ : {} for type_ in Types}
-          for sector in MEMORY_SECTORS[:-1]}
+# Every sector starts at a multiple of this size, so dividing an address by it
+# gives a bucket which belongs to a single sector
+SECTOR_BUCKET_SIZE = reduce(gcd, (sector[1] for sector in MEMORY_SECTORS))
 
-# Activation records used to initialize a function's context
-activation_records = []
-# List for keeping track of where to return after a function
-stored_program_counters = []
+# Name of the sector owning each bucket (None below the first sector)
+SECTOR_OF_BUCKET = [None] * (MEMORY_SECTORS[-1][1] // SECTOR_BUCKET_SIZE)
+for (sector_name, start), (_, end) in zip(MEMORY_SECTORS, MEMORY_SECTORS[1:]):
+    for bucket in range(start // SECTOR_BUCKET_SIZE, end // SECTOR_BUCKET_SIZE):
+        SECTOR_OF_BUCKET[bucket] = sector_name
+
+
+def sector_of(address):
+    """ Return the name of the memory sector holding an address """
+    return SECTOR_OF_BUCKET[address // SECTOR_BUCKET_SIZE]
 
-# Function parameters (special and user-defined)
-parameters = []
-# List of print calls and musical notes
-output = ([], [])
 
 class UninitializedError(Exception):
     """ Raised when a variable address has no value in memory """
@@ -39,10 +43,42 @@ class ArityError(Exception):
     """ Raise when some structure is repeated an invalid number of times """
 
 
-class ChangeContext(Exception):
-    """ Indicate a content change to trigger a storage of context """
-    def __init__(self, goto_line):
-        self.goto_line = goto_line
+class AddressOverflowError(Exception):
+    """ Raise when a memory sector runs out of addresses for a type """
+
+
+class ExecutionLimitExceeded(Exception):
+    """Raised when a program runs for more steps or time than allowed
+
+    quad_idx is the index of the quadruple the program had reached when it was
+    stopped
+    """
+    def __init__(self, message, quad_idx):
+        super().__init__(message)
+        self.quad_idx = quad_idx
+
+
+class CallDepthExceeded(ExecutionLimitExceeded):
+    """ Raised when a program nests more function calls than allowed """
+
+
+def uninitialized_error():
+    """ Create the error raised when an address without a value is read """
+    return UninitializedError('Sorry, but you tried to use a variable before '
+                              'assignment. Please check your program')
+
+
+def division_error(dividend):
+    """ Create the error raised when a value is divided by zero """
+    return ZeroDivisionError(f'Oops! You tried to divide {dividend} by 0. '
+                             f'Please correct your program')
+
+
+def index_error(offset, array_size):
+    """ Create the error raised when an array index is out of bounds """
+    return IndexError(f"Index out of bounds: {offset}. This one should be "
+                      f"greater than or equal to 0 and smaller than "
+                      f"{array_size}")
 
 
 def generate_memory_addresses(end_addresses=False):
@@ -85,227 +121,533 @@ def generate_memory_addresses(end_addresses=False):
     return ADDRESS_TUPLE._make(addresses)
 
 
-addresses = generate_memory_addresses(end_addresses=True)
+# Number of executed quadruples between two checks of the wall clock
+LIMIT_CHECK_INTERVAL = 1024
 
+# Results of pure functions kept by an execution at most. When there are more,
+# the oldest ones are forgotten
+MEMO_SIZE = 10_000
 
-def value(address):
-    """ Return the memory's value associated with an address """
-    try:
-        address = int(address)
-    except ValueError:
-        # Array pointer was found, so remove '&' at the beginning
-        address = value(address[1:])
 
-    try:
-        return get_address_container(address)[address]
-    except KeyError as e:
-        raise UninitializedError(f'Sorry, but you tried to use a variable '
-                                 f'before assignment. Please check your program')
+# A quadruple decoded before execution. Its operator is already resolved to a
+# handler and its operands are integers (or function names)
+Instruction = namedtuple('Instruction', ['opcode', 'handler', 'operands'])
 
+# Entry of the dispatch table. Handlers receive the VM running them and exactly
+# operand_count operands and return the index of the next quadruple only when
+# they jump
+Opcode = namedtuple('Opcode', ['handler', 'operand_count'])
+
+
+# Typecode of the array module keeping the elements of arrays of each type.
+# Arrays of other types (including booleans, which array would turn into
+# integers) keep them in lists
+ARRAY_TYPECODES = {
+    Types.INT : 'q',
+    Types.DEC : 'd',
+}
+
+
+class ArrayStorage():
+    """Elements of a single array, one after the other and indexed by offset
+
+    If an element doesn't fit in the array module's array (like an integer
+    over 64 bits), every element moves to a list. assigned marks the elements
+    written so far, since reading any other one is an error
+    """
+    def __init__(self, type_, size):
+        if type_ in ARRAY_TYPECODES:
+            self.values = array(ARRAY_TYPECODES[type_], [0]) * size
+        else:
+            self.values = [None] * size
+        self.assigned = bytearray(size)
+
+
+    def store(self, offset, value):
+        """ Write the element at an offset """
+        try:
+            self.values[offset] = value
+        except (TypeError, OverflowError):
+            self.values = list(self.values)
+            self.values[offset] = value
+        self.assigned[offset] = True
+
+
+def split_lines(text):
+    """ Generate the lines of a string one by one, without copying it whole """
+    start = 0
+    while True:
+        end = text.find('\n', start)
+        if end == -1:
+            yield text[start:]
+            return
+
+        yield text[start:end]
+        start = end + 1
 
-def store(value_to_store, address):
-    """ Store a value inside a memory address """
-    try:
-        address = int(address)
-    except ValueError:
-        # Array pointer was found, so remove '&' at the beginning
-        address = value(address[1:])
 
-    get_address_container(address)[address] = value_to_store
+def input_lines(inputs):
+    """Return an iterator over the lines of a program's input
+
+    inputs is None (no input at all), a string, whose lines are separated by
+    '\n', or any other iterable of lines, like an open file, whose line breaks
+    are dropped. The lines are only read when the program asks for them
+    """
+    if inputs is None:
+        return iter(())
+    elif isinstance(inputs, str):
+        return split_lines(inputs)
+
+    return (line[:-1] if line.endswith('\n') else line for line in inputs)
+
+
+def new_arrays(function):
+    """ Return the storage of every array declared by a function by address """
+    return {base_address: ArrayStorage(type_, size)
+            for base_address, type_, size in function.arrays}
 
 
-def get_address_container(address):
-    """ Get the internal list containing an address. Used by value and store """
-    for i, sector in enumerate(MEMORY_SECTORS[-2::-1], start=1):
-        sector_name, sector_address = sector
-        # If the address is bigger than this sector, it is contained here
-        if address >= sector_address:
-            for type_address in addresses[-i].items():
-                type_, (start_address, end_address) = type_address
-                # If an address is between the start and end, it belongs here
-                if start_address <= address < end_address:
-                    return memory[sector_name][type_]
+class Orchestra():
+    """Virtual machine in charge of a single execution of a program
 
+    Every instance keeps its own memory, activation records, parameters,
+    inputs and output, so several programs can run at the same time in one
+    process (e.g. in different threads of a web server).
 
-def store_param(address):
-    parameters.append(address)
+    max_steps limits how many quadruples an execution may run, timeout how
+    many seconds it may take and max_call_depth how many function calls may
+    be running at the same time. None means no limit.
+
+    Unless memoize is False, the results of pure functions are remembered by
+    their arguments, so calling them again with the same ones doesn't run them.
+
+    inputs can be anything input_lines accepts. Every line must be read by the
+    program unless allow_unconsumed_input is True. The output goes to an
+    output sink (a BufferedOutput unless another one is given)
+    """
+    def __init__(self, constants, directory, inputs, max_steps=None,
+                 timeout=None, max_call_depth=None, memoize=True,
+                 allow_unconsumed_input=False, output=None):
+        # Actual runtime memory. Each sector maps its addresses to their values
+        # (types don't need their own dictionaries because their address
+        # ranges never overlap)
+        self.memory = {sector[0]: {} for sector in MEMORY_SECTORS[:-1]}
+        self.memory['constant'] = constants
+        # Every array is kept whole at its base address
+        self.memory['global_'].update(
+            new_arrays(directory.functions[directory.GLOBAL_SCOPE]))
+
+        self.directory = directory
+        self.inputs = input_lines(inputs)
+        self.allow_unconsumed_input = allow_unconsumed_input
+
+        # Local frames of the callers suspended by a function call (the
+        # running function's frame is always memory['local'])
+        self.activation_records = []
+        # List for keeping track of the quadruple to return to after a function
+        self.stored_program_counters = []
+
+        self.memoize = memoize
+        # Results of pure functions by their name and arguments
+        self.memo = {}
+        # Memo key of every running call (None for those which aren't kept)
+        self.memo_keys = []
+
+        # Function parameters (special and user-defined)
+        self.parameters = []
+        # Receives the print calls and musical notes
+        self.output = BufferedOutput() if output is None else output
+
+        self.max_steps = max_steps
+        self.timeout = timeout
+        self.max_call_depth = max_call_depth
+        self.deadline = None
+        # Quadruples run until the last jump, where the current run of
+        # quadruples without jumps started and when the limits are checked
+        self.steps = 0
+        self.segment_start = 0
+        self.next_check = float('inf')
+
+
+    def value(self, address):
+        """ Return the memory's value associated with an address """
+        try:
+            return self.get_address_container(address)[address]
+        except KeyError as e:
+            raise uninitialized_error() from e
 
 
-def print_(end='\n'):
-    """ Add a print call to the output """
-    parameter = value(parameters.pop())
+    def store(self, value_to_store, address):
+        """ Store a value inside a memory address """
+        self.get_address_container(address)[address] = value_to_store
+
+
+    def get_address_container(self, address):
+        """ Get the sector dictionary containing an address """
+        return self.memory[sector_of(address)]
+
+
+    def store_param(self, address, position):
+        """ Queue an argument. Its position is given by the order of PARAMs """
+        self.parameters.append(address)
+
+
+    def print_(self, end='\n'):
+        """ Add a print call to the output """
+        parameter = self.value(self.parameters.pop())
+
+        if isinstance(parameter, bool):
+            parameter = str(parameter).lower()
+        else:
+            parameter = str(parameter)
 
-    if isinstance(parameter, bool):
-        parameter = str(parameter).lower()
-    else:
-        parameter = str(parameter)
+        self.output.write(parameter + end)
 
-    output[0].append(parameter + end)
-    # print(printed_value, end=end)
 
+    def get(self, return_address):
+        """ Special function to get the nth character of a string """
+        index = self.value(self.parameters.pop())
+        string = self.value(self.parameters.pop())
+        char = string[index]
+        self.store(char, return_address)
 
-def get(return_address):
-    """ Special function to get the nth character of a string """
-    index = value(parameters.pop())
-    string = value(parameters.pop())
-    char = string[index]
-    store(char, return_address)
 
+    def copy(self):
+        """ Special function to copy a string into another """
+        destination_address = self.parameters.pop()
+        source_value = self.value(self.parameters.pop())
+        self.store(source_value, destination_address)
 
-def copy():
-    """ Special function to copy a string into another """
-    destination_address = parameters.pop()
-    source_value = value(parameters.pop())
-    store(source_value, destination_address)
 
+    def length(self, return_address):
+        """ Special function to calculate the length """
+        self.store(len(self.value(self.parameters.pop())), return_address)
 
-def length(return_address):
-    """ Special function to calculate the length """
-    store(len(value(parameters.pop())), return_address)
 
+    def sqrt_(self, return_address):
+        """ Special function to get the square root """
+        self.store(sqrt(self.value(self.parameters.pop())), return_address)
 
-def sqrt_(return_address):
-    """ Special function to get the square root """
-    store(sqrt(value(parameters.pop())), return_address)
 
+    def log_(self, return_address):
+        """ Special function to get the natural logarithm """
+        self.store(log(self.value(self.parameters.pop())), return_address)
 
-def goto(jump):
-    return int(jump)
 
+    def random_(self, return_address):
+        """ Special function to get a random seed """
+        self.store(random(), return_address)
 
-def gotof(address, jump):
-    if not value(address):
-        return goto(jump)
 
+    def to_str(self, return_address):
+        """ Special function to convert to string """
+        self.store(str(self.value(self.parameters.pop())), return_address)
 
-def verify_limits(offset_address, min_, array_size):
-    """ Check if an array access is off limits """
-    offset = value(offset_address)
-    array_size = int(array_size)
-    min_ = int(min_)
 
-    if not min_ <= offset < array_size:
-        raise IndexError(f"Index out of bounds: {offset}. This one should be "
-                         f"greater than or equal to {min_} and smaller than "
-                         f"{array_size}")
+    def floor_(self, return_address):
+        """ Special function for the floor operation """
+        self.store(floor(self.value(self.parameters.pop())), return_address)
+
+
+    def ceil_(self, return_address):
+        """ Special function for the ceil operation """
+        self.store(ceil(self.value(self.parameters.pop())), return_address)
+
+
+    def input_(self, return_address):
+        """ Special function to read from a user """
+        line = next(self.inputs, None)
+        if line is None:
+            raise ArityError(f"The wrong amount of input lines was submitted")
+
+        self.store(line, return_address)
+
+
+    def add_note(self, note):
+        """ Add a musical note to the output """
+        self.output.add_note(note)
+
+
+    def little_star(self):
+        """ Sample song """
+        for note in 'CCGGAAGFFEEDDC':
+            self.add_note(note)
+
+
+    def append_string(self, value_address, string_address):
+        """Append a value to a string being built
+
+        The string is kept as a list of its pieces until JOIN, so a loop
+        building it doesn't copy it over and over
+        """
+        string = self.value(string_address)
+        value = self.value(value_address)
+
+        if type(string) is list:
+            string.append(value)
+        else:
+            self.store([string, value], string_address)
+
 
-def array_access(base_dir, offset_address, address_pointer):
-    """ Access a validated offset """
-    offset = value(offset_address)
-    base_dir = int(base_dir)
-    store(base_dir + offset, address_pointer)
+    def join_string(self, string_address):
+        """ Turn a string built by APPEND back into a string """
+        container = self.get_address_container(string_address)
+        string = container.get(string_address)
 
+        if type(string) is list:
+            container[string_address] = ''.join(string)
 
-def end_proc(function_name):
-    """ Finish a function definition, Restoring a previous activation record """
-    return_address = directory.functions[function_name].return_address
-    if return_address != None:
-        return_type = directory.functions[function_name].return_type
+
+    def goto(self, jump):
+        return jump
+
+
+    def gotof(self, address, jump):
+        if not self.value(address):
+            return jump
+
+
+    def array_offset(self, offset_address, array_size):
+        """ Return the offset of an array element, checking its limits """
+        offset = self.value(offset_address)
+
+        if not 0 <= offset < array_size:
+            raise index_error(offset, array_size)
+
+        return offset
+
+
+    def element(self, base_address, offset):
+        """ Return an array element whose offset is within bounds """
+        storage = self.get_address_container(base_address)[base_address]
+        if not storage.assigned[offset]:
+            raise uninitialized_error()
+        return storage.values[offset]
+
+
+    def array_load(self, base_address, offset_address, array_size,
+                   result_address):
+        """ Read an array element into an address """
+        offset = self.array_offset(offset_address, array_size)
+        self.store(self.element(base_address, offset), result_address)
+
+
+    def array_store(self, value_address, base_address, offset_address,
+                    array_size):
+        """ Write the value of an address into an array element """
+        offset = self.array_offset(offset_address, array_size)
+        storage = self.get_address_container(base_address)[base_address]
+        storage.store(offset, self.value(value_address))
+
+
+    def array_load_unchecked(self, base_address, offset_address,
+                             result_address):
+        """ Read an array element whose index is known to be within bounds """
+        offset = self.value(offset_address)
+        self.store(self.element(base_address, offset), result_address)
+
+
+    def array_store_unchecked(self, value_address, base_address,
+                              offset_address):
+        """ Write an array element whose index is known to be within bounds """
+        offset = self.value(offset_address)
+        storage = self.get_address_container(base_address)[base_address]
+        storage.store(offset, self.value(value_address))
+
+
+    def end_proc(self, function_name):
+        """ Finish a function call, restoring the caller's activation record """
+        return_address = self.directory.functions[function_name].return_address
+
+        # Drop the callee's frame. If it holds the return value (which is only
+        # the case for local addresses, the other sectors are shared), hand it
+        # back to the caller
+        key = self.memo_keys.pop()
+        if key is not None:
+            self.remember(key, return_address)
+
+        frame = self.memory['local']
+        self.memory['local'] = self.activation_records.pop()
+        if return_address in frame:
+            self.memory['local'][return_address] = frame[return_address]
+
+        return self.stored_program_counters.pop()
+
+
+    def new_frame(self, function):
+        """Return the frame a function starts with, holding only its arguments
+        and its arrays
+
+        The arguments are read while the caller's frame is still the current
+        one
+        """
+        frame = {address: self.value(argument) for address, argument
+                 in zip(function.parameter_addresses, self.parameters)}
+        self.parameters.clear()
+        if function.arrays:
+            frame.update(new_arrays(function))
+        return frame
+
+
+    def gosub(self, function_name, return_quad):
+        """ Suspend the caller's frame and jump to a function """
+        if (self.max_call_depth is not None
+          and len(self.activation_records) >= self.max_call_depth):
+            raise CallDepthExceeded(
+                f'Your program was stopped after nesting '
+                f'{self.max_call_depth} function calls. Check your recursive '
+                f'functions for a missing base case', return_quad - 1)
+
+        function = self.directory.functions[function_name]
+        frame = self.new_frame(function)
+
+        key = None
+        if self.memoize and function.pure:
+            key = (function_name, *(frame[address] for address
+                                    in function.parameter_addresses))
+            if key in self.memo:
+                # The result is already known, so the call is skipped
+                self.store(self.memo[key], function.return_address)
+                return return_quad
+
+        self.activation_records.append(self.memory['local'])
+        self.memory['local'] = frame
+        self.stored_program_counters.append(return_quad)
+        self.memo_keys.append(key)
+        return function.starting_quad
+
+
+    def remember(self, key, return_address):
+        """Keep the result of a pure function's call in the memo
+
+        Nothing is kept if the function never assigned its return address
+        """
         try:
-            # Copy the return value of a context into the previous one
-            return_value = memory['local'][return_type][return_address]
-            activation_records[-1][return_type][return_address] = return_value
+            result = self.get_address_container(return_address)[return_address]
         except KeyError:
-            pass
+            return
 
-    # Restore the previous context
-    memory['local'] = activation_records.pop()
-    return stored_program_counters.pop() + 1
+        if len(self.memo) >= MEMO_SIZE:
+            del self.memo[next(iter(self.memo))]
+        self.memo[key] = result
 
 
-def gosub(function_name):
-    """ Save the current activation record and trigger a context change """
-    activation_records.append(deepcopy(memory['local']))
+    def tail_call(self, function_name):
+        """Replace the caller's frame with a new one and jump to a function
 
-    global directory
-    function = directory.functions[function_name]
-    # Load each argument into the function's new context
-    for type_, address, argument in zip(function.parameter_types,
-                                        function.parameter_addresses,
-                                        parameters):
-        memory['local'][type_][address] = value(argument)
+        The callee returns directly to the caller's caller, so the call
+        doesn't take any extra space
+        """
+        function = self.directory.functions[function_name]
+        self.memory['local'] = self.new_frame(function)
+        return function.starting_quad
 
-    parameters.clear()
-    raise ChangeContext(function.starting_quad)
 
+    def output_after_cleanup(self):
+        if (not self.allow_unconsumed_input
+          and next(self.inputs, None) is not None):
+            raise ArityError(f"The wrong amount of input lines was submitted")
 
-def log_(return_address):
-    """ Special function to get the natural logarithm """
-    store(log(value(parameters.pop())), return_address)
+        return self.output.result()
 
 
-def random_(return_address):
-    """ Special function to get a random seed """
-    store(random(), return_address)
+    def next_limit_check(self, steps):
+        """ Return the step count at which the limits are checked again """
+        if self.deadline is None:
+            return self.max_steps + 1
+        next_check = steps + LIMIT_CHECK_INTERVAL
+        if self.max_steps is not None:
+            next_check = min(next_check, self.max_steps + 1)
+        return next_check
 
 
-def little_star():
-    """ Sample song """
-    C()
-    C()
-    G()
-    G()
-    A()
-    A()
-    G()
+    def check_limits(self, steps, quad_idx):
+        """ Stop the execution if it went over its step or time budget """
+        if self.max_steps is not None and steps > self.max_steps:
+            raise ExecutionLimitExceeded(
+                f'Your program was stopped after running {self.max_steps} '
+                f'instructions. Check it for infinite loops', quad_idx)
 
-    F()
-    F()
-    E()
-    E()
-    D()
-    D()
-    C()
+        if self.deadline is not None and monotonic() >= self.deadline:
+            raise ExecutionLimitExceeded(
+                f'Your program was stopped after running for {self.timeout} '
+                f'seconds. Check it for infinite loops', quad_idx)
 
 
-def A():
-    output[1].append("A")
+    def start_limits(self):
+        """Start the clock of the execution's limits
 
+        Returns whether the execution is limited at all, in which case every
+        jump has to go through jumped
+        """
+        if self.timeout is not None:
+            self.deadline = monotonic() + self.timeout
 
-def B():
-    output[1].append("B")
+        if self.max_steps is None and self.deadline is None:
+            return False
 
+        self.next_check = self.next_limit_check(self.steps)
+        return True
 
-def C():
-    output[1].append("C")
 
+    def jumped(self, quad_idx, target):
+        """Count the quadruples run up to a jump and check the limits
 
-def D():
-    output[1].append("D")
+        A program can only run forever by jumping, so the steps are only
+        counted when a quadruple jumps: every quadruple since the previous jump
+        is counted at once. Returns the jump's target
+        """
+        self.steps += quad_idx - self.segment_start + 1
+        if self.steps >= self.next_check:
+            self.check_limits(self.steps, quad_idx)
+            self.next_check = self.next_limit_check(self.steps)
 
+        self.segment_start = target
+        return target
 
-def E():
-    output[1].append("E")
 
+    def play(self, program):
+        """ Run a decoded program and return its output """
+        limited = self.start_limits()
 
-def F():
-    output[1].append("F")
+        current_quad_idx = 0
+        while current_quad_idx < len(program):
+            instruction = program[current_quad_idx]
 
+            # A handler only returns something when it jumps
+            next_quad_idx = instruction.handler(self, *instruction.operands)
+            if next_quad_idx is None:
+                current_quad_idx += 1
+            elif limited:
+                current_quad_idx = self.jumped(current_quad_idx, next_quad_idx)
+            else:
+                current_quad_idx = next_quad_idx
 
-def G():
-    output[1].append("G")
+        return self.output_after_cleanup()
 
 
-def to_str(return_address):
-    """ Special function to convert to string """
-    store(str(value(parameters.pop())), return_address)
+def binary_operation(operation):
+    """ Create the handler of an operation with two operands """
+    def handler(vm, address1, address2, result_address):
+        value1 = vm.value(address1)
+        value2 = vm.value(address2)
 
+        try:
+            result = operation(value1, value2)
+        except ZeroDivisionError as e:
+            raise division_error(value1) from e
 
-def floor_(return_address):
-    """ Special function for the floor operation """
-    store(floor(value(parameters.pop())), return_address)
+        vm.store(result, result_address)
 
+    return handler
 
-def ceil_(return_address):
-    """ Special function for the ceil operation """
-    store(ceil(value(parameters.pop())), return_address)
 
+def unary_operation(operation):
+    """ Create the handler of an operation with a single operand """
+    def handler(vm, address, result_address):
+        vm.store(operation(vm.value(address)), result_address)
 
-def input_(return_address):
-    """ Special function to read from a user """
-    global input_counter
-    store(inputs[input_counter], return_address)
-    input_counter += 1
+    return handler
 
 
 # Arithmetic operations
@@ -331,37 +673,52 @@ OPERATIONS = {
     '=' : lambda value: value,
 }
 
-# VM functions, which operate mainly through addressess, not values
+# VM functions, which operate mainly through addressess, not values. Their
+# handlers are Orchestra's methods
 VM_FUNCTIONS = {
-    'PARAM' : store_param,
-    'print' : partial(print_, end=''),
-    'println' : print_,
-    'sqrt' : sqrt_,
-    'log' : log_,
-    'get' : get,
-    'little_star' : little_star,
-    'A' : A,
-    'B' : B,
-    'C' : C,
-    'D' : D,
-    'E' : E,
-    'F' : F,
-    'G' : G,
-    'length' : length,
-    'copy' : copy,
-    'random' : random_,
-    'to_str' : to_str,
-    'input' : input_,
-    'floor' : floor_,
-    'ceil' : ceil_,
-    'GOTO' : goto,
-    'GOTOF': gotof,
-    'ACCESS' : array_access,
-    'VER' : verify_limits,
-    'GOSUB' : gosub,
-    'ENDPROC' : end_proc,
+    'PARAM' : Opcode(Orchestra.store_param, 2),
+    'print' : Opcode(partial(Orchestra.print_, end=''), 0),
+    'println' : Opcode(Orchestra.print_, 0),
+    'sqrt' : Opcode(Orchestra.sqrt_, 1),
+    'log' : Opcode(Orchestra.log_, 1),
+    'get' : Opcode(Orchestra.get, 1),
+    'little_star' : Opcode(Orchestra.little_star, 0),
+    'A' : Opcode(partial(Orchestra.add_note, note='A'), 0),
+    'B' : Opcode(partial(Orchestra.add_note, note='B'), 0),
+    'C' : Opcode(partial(Orchestra.add_note, note='C'), 0),
+    'D' : Opcode(partial(Orchestra.add_note, note='D'), 0),
+    'E' : Opcode(partial(Orchestra.add_note, note='E'), 0),
+    'F' : Opcode(partial(Orchestra.add_note, note='F'), 0),
+    'G' : Opcode(partial(Orchestra.add_note, note='G'), 0),
+    'length' : Opcode(Orchestra.length, 1),
+    'copy' : Opcode(Orchestra.copy, 0),
+    'random' : Opcode(Orchestra.random_, 1),
+    'to_str' : Opcode(Orchestra.to_str, 1),
+    'input' : Opcode(Orchestra.input_, 1),
+    'floor' : Opcode(Orchestra.floor_, 1),
+    'ceil' : Opcode(Orchestra.ceil_, 1),
+    'GOTO' : Opcode(Orchestra.goto, 1),
+    'GOTOF': Opcode(Orchestra.gotof, 2),
+    'LOAD' : Opcode(Orchestra.array_load, 4),
+    'STORE' : Opcode(Orchestra.array_store, 4),
+    'LOADU' : Opcode(Orchestra.array_load_unchecked, 3),
+    'STOREU' : Opcode(Orchestra.array_store_unchecked, 3),
+    'APPEND' : Opcode(Orchestra.append_string, 2),
+    'JOIN' : Opcode(Orchestra.join_string, 1),
+    'GOSUB' : Opcode(Orchestra.gosub, 1),
+    'TAILCALL' : Opcode(Orchestra.tail_call, 1),
+    'ENDPROC' : Opcode(Orchestra.end_proc, 1),
 }
 
+# Dispatch table with every instruction the VM understands
+OPCODES = {
+    operator: (Opcode(binary_operation(operation), 3) if operator in OPERATORS
+               else Opcode(unary_operation(operation), 2))
+    for operator, operation in OPERATIONS.items()
+}
+OPCODES.update(VM_FUNCTIONS)
+
+
 # Signature of special functions
 SPECIAL_SIGNATURES = {
     'print' : (None, [{type_ for type_ in Types}]),
@@ -388,109 +745,56 @@ SPECIAL_SIGNATURES = {
 }
 
 
-def handle_vm_function(quad, current_quad_idx):
-    """ Manage a vm function """
+def decode_operand(operand):
+    """ Turn an operand into the integer it holds """
     try:
-        operation = VM_FUNCTIONS[quad[0]]
-        address1 = quad[1]
-        return operation(address1)
-    except TypeError:
-        # Thrown if function needs two parameters
-        address2 = quad[2]
-
-        try:
-            return operation(address1, address2)
-        except TypeError:
-            address3 = quad[3]
-            return operation(address1, address2, address3)
-    except IndexError:
-        # No quad 0: parameterless
-        try:
-            return operation()
-        except TypeError:
-            # Only input would raise such an exception here
-            raise ArityError(f"The wrong amount of input lines was submitted")
-    except ChangeContext as e:
-        stored_program_counters.append(current_quad_idx)
-
-        return e.goto_line
-    except KeyError:
-        raise NotImplementedError(f"This operation isn't supported yet "
-                                  f"({quad[0]})")
+        return int(operand)
+    except ValueError:
+        # Function names (used by calls and ENDPROC) are kept as strings
+        return operand
 
 
-def handle_operation(operation, quad):
-    """ Handle an arithmetical operation """
-    address1 = quad[1]
-    address2 = quad[2]
+def decode_program(quadruples):
+    """Turn a list of quadruples into a list of instructions
 
-    try:
-        address3 = quad[3]
-    except IndexError:
-        # Only 1 operand and 1 address to store the result
-        result = operation(value(address1))
-        store(result, address2)
-    else:
+    This is done once before execution so that the VM never has to split or
+    convert strings while it runs. Unknown operators and quadruples with the
+    wrong number of operands are rejected here.
+    """
+    program = []
+    for quad in quadruples:
         try:
-            # 2 operands and 1 address to store the result
-            value1 = value(address1)
-            value2 = value(address2)
-            result = operation(value1, value2)
-            store(result, address3)
-        except ZeroDivisionError as e:
-            raise ZeroDivisionError(f'Oops! You tried to divide {value1} by 0. '
-                                    f'Please correct your program') from e
-
-
-def output_after_cleanup():
-    global inputs
-    global input_counter
-
-    if input_counter != len(inputs):
-        raise ArityError(f"The wrong amount of input lines was submitted")
-
-    return output
-
+            opcode, *operands = quad.split()
+        except ValueError:
+            # Empty operation (empty line) might only be found at the end
+            break
 
-def play_note(lines, constants, directory_, inputs_):
-    """ Entry point for orchestra """
-    global directory
-    directory = directory_
-    global inputs
-    inputs = inputs_
-    global input_counter
-    input_counter = 0
+        try:
+            handler, operand_count = OPCODES[opcode]
+        except KeyError:
+            raise NotImplementedError(f"This operation isn't supported yet "
+                                      f"({opcode})")
 
-    memory['constant'] = constants
+        if len(operands) != operand_count:
+            raise ArityError(f"The {opcode} operation needs {operand_count} "
+                             f"operand(s), but {len(operands)} were found")
 
-    # Clean the output
-    for list_ in output:
-        list_.clear()
+        operands = tuple(decode_operand(operand) for operand in operands)
 
-    line_list = [line.split() for line in lines.split('\n')]
+        if opcode == 'GOSUB':
+            # Calls also receive the quadruple where execution resumes
+            operands += (len(program) + 1,)
 
-    current_quad_idx = 0
-    while current_quad_idx < len(line_list):
-        try:
-            quad = line_list[current_quad_idx]
-        except IndexError:
-            # Finish when accessing non-existent quadruple (naive GOTO did it)
-            return output_after_cleanup()
+        program.append(Instruction(opcode, handler, operands))
 
-        try:
-            operation = OPERATIONS[quad[0]]
-        except KeyError:
-            vm_result = handle_vm_function(quad, current_quad_idx)
+    return program
 
-            if vm_result is not None:
-                current_quad_idx = vm_result
-            else:
-                current_quad_idx += 1
-        except IndexError:
-            # Empty operation (empty line) might only be found at the end
-            return output_after_cleanup()
-        else:
-            handle_operation(operation, quad)
-            current_quad_idx += 1
 
-    return output_after_cleanup()
+def play_note(lines, constants, directory, inputs, max_steps=None,
+              timeout=None, max_call_depth=None, memoize=True,
+              allow_unconsumed_input=False, output=None):
+    """ Entry point for orchestra. Run the quadruples of a .note file """
+    program = decode_program(lines.split('\n'))
+    return Orchestra(constants, directory, inputs, max_steps, timeout,
+                     max_call_depth, memoize, allow_unconsumed_input,
+                     output).play(program)
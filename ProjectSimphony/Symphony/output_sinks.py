@@ -0,0 +1,137 @@
+"""Destinations of the output of a program's execution.
+
+The Orchestra hands every printed text and every musical note to an output
+sink as soon as the program produces it. The default sink keeps them in memory
+and returns them when the program finishes, but sinks can also pass them on
+right away (to a function, a file or another thread), so a program printing a
+lot doesn't have to hold its whole output in memory.
+"""
+
+from queue import Queue
+from threading import Event
+
+
+class OutputClosed(Exception):
+    """ Raised when a program writes to a stream nobody reads anymore """
+
+
+class OutputSink():
+    """Receives a program's output while it runs
+
+    write receives each printed text (including its line break, if any) and
+    add_note each note. What result returns is what running the program
+    returns. This sink throws everything away
+    """
+    def write(self, text):
+        pass
+
+
+    def add_note(self, note):
+        pass
+
+
+    def result(self):
+        return None
+
+
+class BufferedOutput(OutputSink):
+    """Keep the output in memory and return it as its text and list of notes
+
+    Only the first max_length characters and max_notes notes are kept (None
+    means no limit). truncated tells if anything was left out
+    """
+    def __init__(self, max_length=None, max_notes=None):
+        self.max_length = max_length
+        self.max_notes = max_notes
+        self.prints = []
+        self.notes = []
+        self.length = 0
+        self.truncated = False
+
+
+    def write(self, text):
+        if self.max_length is not None:
+            room = self.max_length - self.length
+            if len(text) > room:
+                text = text[:room]
+                self.truncated = True
+            if not text:
+                return
+
+        self.prints.append(text)
+        self.length += len(text)
+
+
+    def add_note(self, note):
+        if self.max_notes is not None and len(self.notes) >= self.max_notes:
+            self.truncated = True
+            return
+
+        self.notes.append(note)
+
+
+    def result(self):
+        return ''.join(self.prints), self.notes
+
+
+class CallbackOutput(OutputSink):
+    """ Call a function with each printed text and another with each note """
+    def __init__(self, on_print, on_note=None):
+        self.on_print = on_print
+        self.on_note = on_note
+
+
+    def write(self, text):
+        self.on_print(text)
+
+
+    def add_note(self, note):
+        if self.on_note is not None:
+            self.on_note(note)
+
+
+class FileOutput(CallbackOutput):
+    """Write the printed text to an open file
+
+    Notes are passed to on_note, if given, and dropped otherwise
+    """
+    def __init__(self, file, on_note=None):
+        super().__init__(file.write, on_note)
+
+
+class StreamOutput(OutputSink):
+    """Pass the output to another thread through a bounded queue
+
+    The queue gets ('print', text) and ('note', note) items and the program
+    stops (waiting for the reader) when max_pending items are waiting. Once
+    the reader calls close, the next write raises OutputClosed, which stops
+    the program
+    """
+    def __init__(self, max_pending=1024):
+        self.queue = Queue(max_pending)
+        self.closed = Event()
+
+
+    def put(self, item):
+        if self.closed.is_set():
+            raise OutputClosed('Nobody is reading the output anymore')
+        self.queue.put(item)
+
+
+    def write(self, text):
+        self.put(('print', text))
+
+
+    def add_note(self, note):
+        self.put(('note', note))
+
+
+    def close(self):
+        """Stop reading, letting the writer finish
+
+        Items already waiting are thrown away, so a writer blocked on a full
+        queue can notice
+        """
+        self.closed.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
@@ -0,0 +1,71 @@
+"""Cache of compiled programs shared by every execution in a process.
+
+Programs are identified by a hash of their source code and the options they
+were compiled with, so submitting the same source again skips lexing, parsing
+and semantic analysis entirely.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+
+class ProgramCache():
+    """Bounded LRU cache of compiled programs keyed by their source's hash
+
+    It receives the function used to compile a source (and the keyword
+    options of the compilation, which must be hashable) on a cache miss. The
+    least recently used program is evicted once max_size programs are stored.
+    Programs that fail to compile are never stored
+    """
+    def __init__(self, compile_function, max_size=128):
+        self.compile_function = compile_function
+        self.max_size = max_size
+        self.programs = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def compile(self, source, **options):
+        """ Return the compiled program of a source, compiling it if needed """
+        key = (sha256(source.encode()).hexdigest(),
+               tuple(sorted(options.items())))
+
+        with self.lock:
+            try:
+                program = self.programs[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.programs.move_to_end(key)
+                return program
+
+        # Compile without holding the lock so other sources aren't blocked
+        program = self.compile_function(source, **options)
+
+        with self.lock:
+            self.programs[key] = program
+            self.programs.move_to_end(key)
+
+            while len(self.programs) > self.max_size:
+                self.programs.popitem(last=False)
+                self.evictions += 1
+
+        return program
+
+
+    def stats(self):
+        """ Return the cache's counters """
+        with self.lock:
+            return {'size': len(self.programs), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+    def clear(self):
+        """ Remove every program and reset the counters """
+        with self.lock:
+            self.programs.clear()
+            self.hits = self.misses = self.evictions = 0
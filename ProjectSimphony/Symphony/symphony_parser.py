@@ -8,14 +8,23 @@ code for orchestra
  """
 
 from collections import deque
+from copy import copy
+from threading import Lock, Thread
 from Symphony.lexer import (tokens, Types, NonUserTypes, OPERATORS, UNARY_OPERATORS,
-                   CONSTANT_VALS, DUPLICATED_OPERATORS, SELF_UPDATE_OPERATORS)
+                   CONSTANT_VALS, DUPLICATED_OPERATORS, SELF_UPDATE_OPERATORS,
+                   lexer as base_lexer)
 from Symphony.ply.yacc import yacc
 from sys import exit, argv
 
 from Symphony.print_colors import print_red, print_green
-from Symphony.orchestra import (generate_memory_addresses, play_note, ArityError,
-                       SPECIAL_SIGNATURES)
+from Symphony.program_cache import ProgramCache
+from Symphony.optimizer import optimize_quadruples, mark_pure_functions
+from Symphony.closure_engine import play_closures
+from Symphony.transpiler import transpile, play_transpiled
+from Symphony.output_sinks import StreamOutput, OutputClosed
+from Symphony.orchestra import (generate_memory_addresses, decode_program,
+                                Orchestra, ArityError, AddressOverflowError,
+                                SPECIAL_SIGNATURES)
 
 
 # Semantic cube. In charge of validating if an operation can be applied to two
@@ -68,12 +77,53 @@ UNARY_TABLE = [
     [Types.DEC.value] *4,
 ]
 
-# Directory an quadruple generator contain the single instance of their eponymous
-# classes. This was not necessary, but the team did not know about the
-# possibility of encapsulating parts of the grammar and semantics in a module
-# when working with PLY
-directory = None
-quadruple_generator = None
+# Largest program (in quadruples) that is optimized. Compiling isn't bounded
+# by the execution limits, so bigger ones are run as they were generated
+MAX_OPTIMIZED_QUADRUPLES = 20_000
+
+# PLY's parser is built once per process and reused by every compilation.
+# Building it means reflecting over this module's grammar and generating or
+# reading its LALR tables, which takes much longer than most compilations
+lalr_parser = None
+lalr_parser_lock = Lock()
+
+# Ways of running a compiled program in an Orchestra, selected per execution.
+# 'dispatch' looks up each instruction's handler as it runs, 'closures'
+# compiles every instruction into a closure before running them and
+# 'transpiled' runs the program's code object, generated the first time
+ENGINES = {
+    'dispatch' : lambda orchestra, program: orchestra.play(
+        program.instructions),
+    'closures' : lambda orchestra, program: play_closures(
+        orchestra, program.instructions),
+    'transpiled' : lambda orchestra, program: play_transpiled(
+        orchestra, program.transpiled()),
+}
+
+
+class CompiledProgram():
+    """Everything the VM needs to run a program, produced by compile_program
+
+    The instructions are the quadruples already decoded for the VM. Their
+    Python translation is only generated when the transpiled engine runs the
+    program for the first time, and kept in code
+    """
+    def __init__(self, quadruples, instructions, constants, directory):
+        self.quadruples = quadruples
+        self.instructions = instructions
+        self.constants = constants
+        self.directory = directory
+        self.code = None
+
+
+    def transpiled(self):
+        """ Return the code object of the program, transpiling it if needed """
+        # Threads transpiling it at once get equivalent code objects, so
+        # there's nothing to lock
+        if self.code is None:
+            self.code = transpile(self.instructions, self.directory)
+
+        return self.code
 
 
 class FunctionScope():
@@ -87,6 +137,10 @@ class FunctionScope():
         self.first_quadruple = None
         self.return_address = None
         self.starting_quad = starting_quad
+        # Base address, type and size of every array declared in the scope
+        self.arrays = []
+        # Whether the VM can memoize the function's calls (see the optimizer)
+        self.pure = False
 
 
 class Directory():
@@ -97,7 +151,8 @@ class Directory():
     """
     GLOBAL_SCOPE = None
 
-    def __init__(self):
+    def __init__(self, quadruple_generator):
+        self.quadruple_generator = quadruple_generator
         self.current_scope = None
         self.functions = {}
         self.define_function('VOID', Directory.GLOBAL_SCOPE, 0)
@@ -117,7 +172,7 @@ class Directory():
 
         self.functions[self.current_scope].variables.clear()
         self.current_scope = Directory.GLOBAL_SCOPE
-        quadruple_generator.generate_quad('ENDPROC', current_function.name)
+        self.quadruple_generator.generate_quad('ENDPROC', current_function.name)
 
 
     def declare_variables(self, parameters, variables, line_number,
@@ -130,7 +185,7 @@ class Directory():
         """
         # Store where the function starts
         self.functions[self.current_scope].first_quadruple = len(
-            quadruple_generator.quadruples)
+            self.quadruple_generator.quadruples)
 
         for parameter in parameters:
             # parameter[0] has its type, which is stored in the signature
@@ -156,8 +211,9 @@ class Directory():
                                      f' than once')
 
         # Create a new function with a starting quad in the current quad
-        starting_quad = len(quadruple_generator.quadruples)
+        starting_quad = len(self.quadruple_generator.quadruples)
         self.current_scope = function
+        self.quadruple_generator.reset_temporal_pool()
         self.functions[function] = FunctionScope(return_type, function,
                                                  starting_quad)
 
@@ -182,7 +238,7 @@ class Directory():
             # Create a non-dimensional variable
             current_function_vars[variable_name] = (
                 variable_type,
-                quadruple_generator.generate_variable_address(variable_type,
+                self.quadruple_generator.generate_variable_address(variable_type,
                                                               is_global),
                 variable_name,
             )
@@ -203,7 +259,7 @@ class Directory():
             # Create a dimensional variable
             current_function_vars[variable_name] = (
                 NonUserTypes.ARRAY,
-                quadruple_generator.generate_variable_address(
+                self.quadruple_generator.generate_variable_address(
                     variable_type,
                     is_global,
                     array_size_value
@@ -212,6 +268,9 @@ class Directory():
                 variable_type,
                 array_size_value
             )
+            self.functions[self.current_scope].arrays.append(
+                (current_function_vars[variable_name][1], variable_type,
+                 array_size_value))
 
 
     def get_variable(self, name, line_number):
@@ -240,9 +299,10 @@ class QuadrupleGenerator():
     operands, jumps, recursive calls (They are created when a function
     definition is not finished and must receive a return address later on).
     """
-    def __init__(self, filepath, inputs):
+    def __init__(self):
+        self.directory = None
         self.ADDRESSES = generate_memory_addresses()
-        self.filepath = filepath
+        self.ADDRESS_LIMITS = generate_memory_addresses(end_addresses=True)
         self.operands = []
         self.CONSTANT_ADDRESS_DICT = {type_: {} for type_ in Types}
         self.quadruples = []
@@ -253,11 +313,10 @@ class QuadrupleGenerator():
         self.recursive_calls = []
         self.pending_breaks = []
         self.open_whiles = 0
-
-        try:
-            self.inputs = inputs.split('\n')
-        except AttributeError:
-            self.inputs = []
+        # Temporal addresses whose value is no longer needed, by type
+        self.free_temporals = {type_: [] for type_ in Types}
+        # Array elements loaded in each temporal (base, offset and size)
+        self.loaded_elements = {}
 
 
     def pop_operand(self, line_number):
@@ -291,6 +350,7 @@ class QuadrupleGenerator():
 
             self.generate_quad(operator_symbol, left_address,
                                              right_address, result_address)
+            self.release_temporals(left_address, right_address)
             self.operands.append((result_type, result_address))
         except IndexError:
             raise TypeError(
@@ -337,6 +397,7 @@ class QuadrupleGenerator():
 
                 self.generate_quad(operator, left_address, right_address,
                                    result_address)
+                self.release_temporals(left_address, right_address)
                 left_operand = (result_type, result_address)
             except IndexError:
                 raise TypeError(
@@ -368,6 +429,10 @@ class QuadrupleGenerator():
                 operator_symbol = DUPLICATED_OPERATORS[operator_symbol]
 
             self.generate_quad(operator_symbol, address, result_address)
+            if result_address != address:
+                self.release_temporals(address)
+            else:
+                self.write_back(address)
             self.operands.append((result_type, result_address))
         except IndexError:
             raise TypeError(
@@ -387,6 +452,7 @@ class QuadrupleGenerator():
 
         self.pending_jumps.append(len(self.quadruples))
         self.generate_quad('GOTOF', address)
+        self.release_temporals(address)
 
 
     def add_pending_if(self):
@@ -430,11 +496,11 @@ class QuadrupleGenerator():
 
     def assign(self, name, line_number):
         """ Assign a variable with a given name """
-        variable = directory.get_variable(name, line_number)
+        variable = self.directory.get_variable(name, line_number)
 
         try:
-            offset_type, offset_value = directory.current_array_offset
-            del directory.current_array_offset
+            offset_type, offset_value = self.directory.current_array_offset
+            del self.directory.current_array_offset
         except AttributeError:
             left_type = variable[0]
             left_address = variable[1]
@@ -457,28 +523,23 @@ class QuadrupleGenerator():
 
             # The array's real type
             left_type = variable[3]
-
-            # generate verification quad
-            array_size_value = variable[4]
-            self.generate_quad('VER', offset_value, 0, array_size_value)
-
-            # Generate a left address using the offset of the access
-            base_address = variable[1]
-            left_address = self.generate_temporal_address(left_type)
-            self.generate_quad('ACCESS', base_address, offset_value, left_address)
-            # '&' is used for pointers in orchestra. As the base address and the
-            # offset address were added like integers, the VM has to remember to
-            # Dereference the addition
-            left_address = "&" + str(left_address)
+            left_address = None
 
         right_type, right_address = self.pop_operand(line_number)
-        if left_type == right_type:
-            self.generate_quad('=', right_address, left_address)
-        else:
+        if left_type != right_type:
             raise TypeError(f'Error on line {line_number}: you are trying '
                             f'to assign a(n) {right_type.name} value to '
                             f'a(n) {left_type.name} type')
 
+        if left_address is None:
+            # STORE checks the offset against the array size before writing
+            self.generate_quad('STORE', right_address, variable[1],
+                               offset_value, variable[4])
+            self.release_temporals(right_address, offset_value)
+        else:
+            self.generate_quad('=', right_address, left_address)
+            self.release_temporals(right_address)
+
 
     def generate_quad(self, *args):
         self.quadruples.append(' '.join(str(arg) for arg in args))
@@ -486,6 +547,7 @@ class QuadrupleGenerator():
 
     def generate_main_goto(self):
         self.quadruples[0] += ' ' + str(len(self.quadruples))
+        self.reset_temporal_pool()
 
 
     def read_parameter(self, line_number):
@@ -495,7 +557,7 @@ class QuadrupleGenerator():
     def call(self, function, line_number):
         """ Call a function, verifying its signature first """
         called_function_name = self.called_functions.pop()
-        called_function = directory.functions[called_function_name]
+        called_function = self.directory.functions[called_function_name]
         parameter_types = called_function.parameter_types
 
         if len(self.arguments) != len(parameter_types):
@@ -505,6 +567,9 @@ class QuadrupleGenerator():
                              f'{called_function_name}. It needs '
                              f'{len(parameter_types)}')
 
+        if called_function_name == self.directory.current_scope:
+            self.spill_temporals()
+
         # Generate parameter load quadruples if types allow it
         for i, (argument, parameter_type) in enumerate(
           zip(self.arguments, parameter_types), start=1):
@@ -520,11 +585,14 @@ class QuadrupleGenerator():
             self.generate_quad('PARAM', argument_address, i)
 
         self.generate_quad('GOSUB', called_function_name)
+        # Arguments are read when the function is called
+        self.release_temporals(*(address for _, address in self.arguments))
         self.arguments.clear()
 
         # Generate a return function for non-voids
         if called_function.return_type != 'VOID':
-            is_global = directory.current_scope == directory.GLOBAL_SCOPE
+            is_global = (self.directory.current_scope
+                         == self.directory.GLOBAL_SCOPE)
 
             # Store the resulting address of a local variable which will
             # contain the return value. It's local to prevent the VM from
@@ -577,12 +645,16 @@ class QuadrupleGenerator():
 
         if return_type == None:
             self.generate_quad(called_function_name)
+
+            if called_function_name == 'copy':
+                self.write_back(self.arguments[-1][1])
         else:
             # If the special call has a return type, add a temp address
             return_address = self.generate_temporal_address(return_type)
             self.generate_quad(called_function_name, return_address)
             self.operands.append((return_type, return_address))
 
+        self.release_temporals(*(address for _, address in self.arguments))
         self.arguments.clear()
 
 
@@ -591,40 +663,113 @@ class QuadrupleGenerator():
         if is_global:
             # ADDRESSES is a special structure for book keeping
             new_address = self.ADDRESSES.global_[variable_type]
+            self.check_address_limit('global_', variable_type,
+                                     new_address + reserved)
             self.ADDRESSES.global_[variable_type] = new_address + reserved
         else:
             new_address = self.ADDRESSES.local[variable_type]
+            self.check_address_limit('local', variable_type,
+                                     new_address + reserved)
             self.ADDRESSES.local[variable_type] = new_address + reserved
 
         return new_address
 
 
+    def check_address_limit(self, sector, variable_type, next_address):
+        """ Fail if a sector ran out of addresses for a type """
+        start_address, end_address = getattr(self.ADDRESS_LIMITS,
+                                             sector)[variable_type]
+
+        if next_address > end_address:
+            raise AddressOverflowError(f'Your program needs too many '
+                                       f'{sector.strip("_")} '
+                                       f'{variable_type.name} values. It '
+                                       f'can only use '
+                                       f'{end_address - start_address}')
+
+
     def push_constant(self, type_, value):
         """ Add a constat to the constant dictionary """
+        self.operands.append((type_, self.constant_address(type_, value)))
+
+
+    def constant_address(self, type_, value):
+        """ Return the address of a constant, registering it if it's new """
         try:
             address = self.CONSTANT_ADDRESS_DICT[type_][value]
         except KeyError:
             # Store address just to use it later (Otherwise it's a += 1)
             address = self.ADDRESSES.constant[type_]
+            self.check_address_limit('constant', type_, address + 1)
             self.ADDRESSES.constant[type_] = address + 1
 
             self.CONSTANT_ADDRESS_DICT[type_][value] = address
 
-        self.operands.append((type_, address))
+        return address
 
 
     def generate_temporal_address(self, variable_type):
+        """ Return a temporal address, reusing a released one if possible """
+        free_temporals = self.free_temporals[variable_type]
+        if free_temporals:
+            address = free_temporals.pop()
+            # Whatever it had loaded is no longer there
+            self.loaded_elements.pop(address, None)
+            return address
+
         new_address = self.ADDRESSES.temporal[variable_type]
+        self.check_address_limit('temporal', variable_type, new_address + 1)
         self.ADDRESSES.temporal[variable_type] = new_address + 1
         return new_address
 
 
-    def write_quads(self):
-        """ Write quadruples in a .note file named like the original symphony"""
-        self.filepath = self.filepath[:-4] + '.note'
+    def release_temporals(self, *addresses):
+        """Let the temporal addresses among some operands be reused
 
-        with open(self.filepath, 'w') as file:
-            file.write('\n'.join(self.quadruples))
+        Operands are released once the quadruple consuming them is generated.
+        Return addresses are never consumed this way, since callers read them
+        after the function ends
+        """
+        for address in addresses:
+            for type_, (start, end) in self.ADDRESS_LIMITS.temporal.items():
+                if (start <= address < end
+                  and address not in self.free_temporals[type_]):
+                    self.free_temporals[type_].append(address)
+
+
+    def spill_temporals(self):
+        """Move the temporals still waiting to be used to local variables
+
+        A recursive call runs the same quadruples as its caller, so it would
+        overwrite the temporals the caller is in the middle of using (they
+        live in global memory). Locals belong to each call
+        """
+        for operand_idx, (type_, address) in enumerate(self.operands):
+            if any(start <= address < end for start, end
+                   in self.ADDRESS_LIMITS.temporal.values()):
+                local_address = self.generate_variable_address(type_, False)
+                self.generate_quad('=', address, local_address)
+                self.release_temporals(address)
+                self.operands[operand_idx] = (type_, local_address)
+
+
+    def reset_temporal_pool(self):
+        """Forget every released temporal
+
+        Temporals live in global memory, so a function never reuses the ones
+        released by another: a call in the middle of an expression would
+        overwrite the caller's pending values. Calls of a function to itself
+        spill them instead (see spill_temporals)
+        """
+        for free_temporals in self.free_temporals.values():
+            free_temporals.clear()
+
+
+    def constant_table(self):
+        """ Invert the constant's dictionary to address -> value """
+        return {address: value for value_address in
+                self.CONSTANT_ADDRESS_DICT.values()
+                for value, address in value_address.items()}
 
 
     def store_expression_position(self):
@@ -634,7 +779,7 @@ class QuadrupleGenerator():
     def init_call(self, function, line_number):
         """ Initialize a call to a function """
         try:
-            directory.functions[function]
+            self.directory.functions[function]
         except KeyError:
             raise NameError(f'Error on line {line_number}: You tried'
                             f' to use the function {function}, but it was'
@@ -648,13 +793,13 @@ class QuadrupleGenerator():
 
     def generate_return(self, line_number):
         """ Generate a retun """
-        current_function = directory.functions[directory.current_scope]
+        current_function = self.directory.functions[self.directory.current_scope]
 
         if current_function.return_address is not None:
             raise MisplacedStatementError('You cannot have multiple returns inside a '
                               'function')
 
-        if directory.current_scope == directory.GLOBAL_SCOPE:
+        if self.directory.current_scope == self.directory.GLOBAL_SCOPE:
             raise MisplacedStatementError(f'Error on line {line_number}: You cannot use '
                               f'return if you are not inside a function')
 
@@ -676,6 +821,19 @@ class QuadrupleGenerator():
         current_function.return_address = return_address
         for quad_idx, result_address in self.recursive_calls:
             self.quadruples[quad_idx] += f' {return_address} {result_address}'
+        self.recursive_calls.clear()
+
+
+    def write_back(self, address):
+        """Store a temporal back into the array element it was loaded from
+
+        Array elements are updated in a temporal (by ++, -- and copy). The
+        offset was released by the LOAD, but no temporal was requested since
+        then. Nothing is done for any other address
+        """
+        if address in self.loaded_elements:
+            self.generate_quad('STORE', address,
+                               *self.loaded_elements.pop(address))
 
 
     def generate_access(self, array_name, line_number):
@@ -688,7 +846,7 @@ class QuadrupleGenerator():
                             f'{offset_type.name}, but you should use '
                             f'a(n) {Types.INT.name} instead')
 
-        variable = directory.get_variable(array_name, line_number)
+        variable = self.directory.get_variable(array_name, line_number)
 
         type_ = variable[0]
 
@@ -697,14 +855,34 @@ class QuadrupleGenerator():
                             f"your {array_name} variable, but it's not an array")
 
         array_size_value = variable[4]
-        self.generate_quad('VER', offset_value, 0, array_size_value)
-
         base_address = variable[1]
         real_type = variable[3]
         result_address = self.generate_temporal_address(real_type)
 
-        self.generate_quad('ACCESS', base_address, offset_value, result_address)
-        return real_type, "&" + str(result_address)
+        # LOAD checks the offset against the array size before reading
+        self.generate_quad('LOAD', base_address, offset_value,
+                           array_size_value, result_address)
+        self.release_temporals(offset_value)
+
+        # Kept in case the element is incremented, decremented or copied into,
+        # which has to write it back right after
+        self.loaded_elements[result_address] = (base_address, offset_value,
+                                                array_size_value)
+        return real_type, result_address
+
+
+class CompilationContext():
+    """Semantic state of a single compilation
+
+    It joins a Directory and a QuadrupleGenerator, which need each other. The
+    context travels with the lexer given to PLY (p.lexer.context), so grammar
+    actions never touch module globals and several programs can be compiled
+    at the same time
+    """
+    def __init__(self):
+        self.quadruple_generator = QuadrupleGenerator()
+        self.directory = Directory(self.quadruple_generator)
+        self.quadruple_generator.directory = self.directory
 
 
 class GrammaticalError(Exception):
@@ -719,24 +897,20 @@ class MisplacedStatementError(Exception):
     """ Raise when a statement is misplaced (like a break outside a loop) """
 
 
-def finalize():
-    quadruple_generator.write_quads()
-
-
 def p_program(p):
     ''' program : PROGRAM ID ';' global_declarations function_declaration main_goto statements '''
-    finalize()
 
 
 def p_main_goto(p):
     ''' main_goto : empty '''
-    quadruple_generator.generate_main_goto()
+    p.lexer.context.quadruple_generator.generate_main_goto()
 
 
 def p_global_declarations(p):
     ''' global_declarations : variable_declaration '''
-    quadruple_generator.generate_quad('GOTO')
-    directory.declare_variables([], p[1], p.lexer.lineno, is_global=True)
+    p.lexer.context.quadruple_generator.generate_quad('GOTO')
+    p.lexer.context.directory.declare_variables([], p[1], p.lexer.lineno,
+                                                is_global=True)
 
 
 def p_empty(p):
@@ -805,24 +979,25 @@ def p_array_declaration(p):
     ''' array_declaration : ID '[' int_val ']' '''
     p[0] = p[1], p[3]
     # The array size won't be used by anyone else
-    quadruple_generator.pop_operand(p.lexer.lineno)
+    p.lexer.context.quadruple_generator.pop_operand(p.lexer.lineno)
 
 
 def p_non_array_usage(p):
     ''' non_array_usage : ID '''
     # return type and address from vartable
-    p[0] = directory.get_variable(p[1], p.lexer.lineno)[0:2]
+    p[0] = p.lexer.context.directory.get_variable(p[1], p.lexer.lineno)[0:2]
 
 
 def p_array_usage(p):
     ''' array_usage : ID '[' expression ']' '''
-    p[0] = quadruple_generator.generate_access(p[1], p.lexer.lineno)
+    p[0] = p.lexer.context.quadruple_generator.generate_access(p[1], p.lexer.lineno)
 
 
 def p_array_assignment(p):
     ''' array_assignment : ID '[' expression ']' '''
-    directory.current_array_offset = quadruple_generator.pop_operand(
-        p.lexer.lineno)
+    context = p.lexer.context
+    context.directory.current_array_offset = (
+        context.quadruple_generator.pop_operand(p.lexer.lineno))
     p[0] = p[1]
 
 
@@ -833,7 +1008,7 @@ def p_expression(p):
 
 def p_exp_op(p):
     ''' exp_op : level1 EXPONENTIATION expression '''
-    quadruple_generator.operate_right(p[2], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_right(p[2], p.lexer.lineno)
 
 
 def p_level1(p):
@@ -844,7 +1019,7 @@ def p_level1(p):
 def p_plus_minus_op(p):
     ''' plus_minus_op : '+' level2
                       | '-' level2 '''
-    quadruple_generator.operate_unary(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_unary(p[1], p.lexer.lineno)
 
 
 def p_level2(p):
@@ -855,7 +1030,7 @@ def p_level2(p):
 def p_logical_op(p):
     ''' logical_op : level3 OR level3 chained_logical_ops
                    | level3 AND level3 chained_logical_ops '''
-    quadruple_generator.operate_left(p[2], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_left(p[2], p.lexer.lineno)
 
 
 def p_chained_logical_ops(p):
@@ -865,7 +1040,7 @@ def p_chained_logical_ops(p):
 def p_chained_logical_op(p):
     ''' chained_logical_op : OR level3 chained_logical_ops
                            | AND level3 chained_logical_ops '''
-    quadruple_generator.chained_operators.append(p[1])
+    p.lexer.context.quadruple_generator.chained_operators.append(p[1])
 
 
 def p_level3(p):
@@ -879,7 +1054,7 @@ def p_rel_op(p):
                | level4 LESS_EQUAL_THAN level4 chained_rel_ops
                | level4 GREATER_EQUAL_THAN level4 chained_rel_ops
                | level4 EQUALS level4 chained_rel_ops '''
-    quadruple_generator.operate_left(p[2], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_left(p[2], p.lexer.lineno)
 
 
 def p_chained_rel_ops(p):
@@ -892,7 +1067,7 @@ def p_chained_rel_op(p):
                        | LESS_EQUAL_THAN level4 chained_rel_ops
                        | GREATER_EQUAL_THAN level4 chained_rel_ops
                        | EQUALS level4 chained_rel_ops '''
-    quadruple_generator.chained_operators.append(p[1])
+    p.lexer.context.quadruple_generator.chained_operators.append(p[1])
 
 
 def p_level4(p):
@@ -903,7 +1078,7 @@ def p_level4(p):
 def p_add_subs_op(p):
     ''' add_subs_op : level5 '+' level5 chained_add_subs_ops
                     | level5 '-' level5 chained_add_subs_ops '''
-    quadruple_generator.operate_left(p[2], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_left(p[2], p.lexer.lineno)
 
 
 def p_chained_add_subs_ops(p):
@@ -913,7 +1088,7 @@ def p_chained_add_subs_ops(p):
 def p_chained_add_subs_op(p):
     ''' chained_add_subs_op : '+' level5 chained_add_subs_ops
                             | '-' level5 chained_add_subs_ops '''
-    quadruple_generator.chained_operators.append(p[1])
+    p.lexer.context.quadruple_generator.chained_operators.append(p[1])
 
 
 def p_level5(p):
@@ -924,14 +1099,14 @@ def p_level5(p):
 
 def p_negation_op(p):
     ''' negation_op : NOT level6 '''
-    quadruple_generator.operate_unary(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_unary(p[1], p.lexer.lineno)
 
 
 def p_times_div_mod_op(p):
     ''' times_div_mod_op : level6 '*' level6 chained_times_div_mod_ops
                          | level6 '/' level6 chained_times_div_mod_ops
                          | level6 MOD level6 chained_times_div_mod_ops '''
-    quadruple_generator.operate_left(p[2], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_left(p[2], p.lexer.lineno)
 
 
 def p_chained_times_div_mod_ops(p):
@@ -942,7 +1117,7 @@ def p_chained_times_div_mod_op(p):
     ''' chained_times_div_mod_op : '*' level6 chained_times_div_mod_ops
                                  | '/' level6 chained_times_div_mod_ops
                                  | MOD level6 chained_times_div_mod_ops '''
-    quadruple_generator.chained_operators.append(p[1])
+    p.lexer.context.quadruple_generator.chained_operators.append(p[1])
 
 
 def p_level6(p):
@@ -954,17 +1129,17 @@ def p_level6(p):
 
 def p_increment(p):
     ''' increment : INCREMENT variable_id '''
-    quadruple_generator.operate_unary(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_unary(p[1], p.lexer.lineno)
 
 
 def p_decrement(p):
     ''' decrement : DECREMENT variable_id '''
-    quadruple_generator.operate_unary(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.operate_unary(p[1], p.lexer.lineno)
 
 
 def p_break(p):
     ''' break : BREAK '''
-    quadruple_generator.generate_break(p.lexer.lineno)
+    p.lexer.context.quadruple_generator.generate_break(p.lexer.lineno)
 
 
 def p_function_declaration(p):
@@ -974,17 +1149,17 @@ def p_function_declaration(p):
 
 def p_function(p):
     '''function : create_scope parameters_and_variables statements '}' '''
-    directory.end_definition(p.lexer.lineno)
+    p.lexer.context.directory.end_definition(p.lexer.lineno)
 
 
 def p_create_scope(p):
     ''' create_scope : FUN return_type ID '''
-    directory.define_function(p[2], p[3], p.lexer.lineno)
+    p.lexer.context.directory.define_function(p[2], p[3], p.lexer.lineno)
 
 
 def p_parameters_and_variables(p):
     ''' parameters_and_variables : '(' parameters ')' '{' variable_declaration '''
-    directory.declare_variables(p[2], p[5], p.lexer.lineno)
+    p.lexer.context.directory.declare_variables(p[2], p[5], p.lexer.lineno)
 
 
 def p_return_type(p):
@@ -1030,12 +1205,12 @@ def p_no_colon_statement(p):
 
 def p_call(p):
     ''' call : call_id '(' arguments ')' '''
-    quadruple_generator.call(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.call(p[1], p.lexer.lineno)
 
 
 def p_call_id(p):
     ''' call_id : ID '''
-    quadruple_generator.init_call(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.init_call(p[1], p.lexer.lineno)
 
 
 def p_arguments(p):
@@ -1046,12 +1221,12 @@ def p_arguments(p):
 def p_argument_list(p):
     ''' argument_list : expression
                       | expression ',' arguments '''
-    quadruple_generator.read_parameter(p.lexer.lineno)
+    p.lexer.context.quadruple_generator.read_parameter(p.lexer.lineno)
 
 
 def p_assignment(p):
     ''' assignment : assignment_id '=' expression '''
-    quadruple_generator.assign(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.assign(p[1], p.lexer.lineno)
 
 
 def p_condition(p):
@@ -1065,48 +1240,50 @@ def p_optional_elses(p):
 
 def p_if_quad(p):
     ''' if_quad : empty '''
-    quadruple_generator.generate_boolean_structure(p.lexer.lineno, 'if')
+    p.lexer.context.quadruple_generator.generate_boolean_structure(
+        p.lexer.lineno, 'if')
 
 
 def p_add_pending_if(p):
     ''' add_pending_if : empty '''
-    quadruple_generator.add_pending_if()
+    p.lexer.context.quadruple_generator.add_pending_if()
 
 
 def p_cycle(p):
     ''' cycle : WHILE '(' store_expression_position expression while_quad ')' block add_pending_while'''
-    quadruple_generator.open_whiles -= 1
+    p.lexer.context.quadruple_generator.open_whiles -= 1
 
 
 def p_add_pending_while(p):
     ''' add_pending_while : empty '''
-    quadruple_generator.add_pending_while()
+    p.lexer.context.quadruple_generator.add_pending_while()
 
 
 def p_while_quad(p):
     ''' while_quad : empty '''
-    quadruple_generator.generate_boolean_structure(p.lexer.lineno, 'while')
-    quadruple_generator.open_whiles += 1
+    p.lexer.context.quadruple_generator.generate_boolean_structure(
+        p.lexer.lineno, 'while')
+    p.lexer.context.quadruple_generator.open_whiles += 1
 
 
 def p_store_expression_position(p):
     ''' store_expression_position : empty '''
-    quadruple_generator.store_expression_position()
+    p.lexer.context.quadruple_generator.store_expression_position()
 
 
 def p_special(p):
     ''' special : special_id '(' arguments ')' '''
-    quadruple_generator.special_call(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.special_call(p[1], p.lexer.lineno)
 
 
 def p_special_id(p):
     ''' special_id : SPECIAL_ID '''
-    quadruple_generator.init_special(p[1], p.lexer.lineno)
+    p.lexer.context.quadruple_generator.init_special(p[1], p.lexer.lineno)
 
 
 def p_return(p):
     ''' return : RETURN expression '''
-    quadruple_generator.generate_return(p.lexer.lineno)
+    p.lexer.context.quadruple_generator.generate_return(p.lexer.lineno)
 
 
 def p_elses(p):
@@ -1125,12 +1302,12 @@ def p_elseif_else(p):
 
 def p_else(p):
     ''' else : ELSE '''
-    quadruple_generator.add_else_jumps()
+    p.lexer.context.quadruple_generator.add_else_jumps()
 
 
 def p_elseif(p):
     ''' elseif : ELSEIF '''
-    quadruple_generator.add_else_jumps()
+    p.lexer.context.quadruple_generator.add_else_jumps()
 
 
 def p_parameters(p):
@@ -1186,33 +1363,34 @@ def p_const(p):
 
 def p_int_val(p):
     ''' int_val : INT_VAL '''
-    quadruple_generator.push_constant(Types.INT, p[1])
+    p.lexer.context.quadruple_generator.push_constant(Types.INT, p[1])
     p[0] = Types.INT, p[1]
 
 
 def p_dec_val(p):
     ''' dec_val : DEC_VAL '''
-    quadruple_generator.push_constant(Types.DEC, p[1])
+    p.lexer.context.quadruple_generator.push_constant(Types.DEC, p[1])
 
 
 def p_char_val(p):
     ''' char_val : CHAR_VAL '''
-    quadruple_generator.push_constant(Types.CHAR, p[1])
+    p.lexer.context.quadruple_generator.push_constant(Types.CHAR, p[1])
 
 
 def p_str_val(p):
     ''' str_val : STR_VAL '''
-    quadruple_generator.push_constant(Types.STR, p[1])
+    p.lexer.context.quadruple_generator.push_constant(Types.STR, p[1])
 
 
 def p_bool_val(p):
     ''' bool_val : BOOL_VAL '''
-    quadruple_generator.push_constant(Types.BOOL, CONSTANT_VALS[p[1]])
+    p.lexer.context.quadruple_generator.push_constant(Types.BOOL,
+                                                      CONSTANT_VALS[p[1]])
 
 
 def p_variable_id(p):
     ''' variable_id : usage_id '''
-    quadruple_generator.operands.append((p[1][0], p[1][1]))
+    p.lexer.context.quadruple_generator.operands.append((p[1][0], p[1][1]))
 
 
 def p_function_result(p):
@@ -1228,32 +1406,172 @@ def p_error(p):
     raise GrammaticalError(p)
 
 
-def create_parser(filepath, inputs=None):
-    global quadruple_generator
-    global directory
-    quadruple_generator = QuadrupleGenerator(filepath, inputs)
-    directory = Directory()
-    return yacc()
+def create_parser():
+    """ Return a parser for a single compilation """
+    global lalr_parser
+    with lalr_parser_lock:
+        if lalr_parser is None:
+            # Existing tables are read if they match the grammar, but nothing
+            # is ever written next to the sources (parsetab.py or parser.out)
+            lalr_parser = yacc(debug=False, write_tables=False)
+
+    # PLY keeps its parsing stacks as attributes, so each compilation gets its
+    # own shallow copy. The (read-only) tables are still shared
+    return copy(lalr_parser)
+
+
+def compile_program(source, note_path=None, optimize=True,
+                    keep_bounds_checks=False):
+    """Compile a program's source code and return it ready to be run
+
+    The quadruples are optimized unless requested otherwise or there are more
+    than MAX_OPTIMIZED_QUADRUPLES of them, and they are only written to a
+    .note file if a path is given. The optimizer removes the
+    bounds checks of array accesses it proves valid, unless asked to keep
+    them (which helps when debugging the VM)
+    """
+    context = CompilationContext()
+
+    lexer = base_lexer.clone()
+    lexer.lineno = 1
+    lexer.context = context
+
+    create_parser().parse(source, lexer=lexer)
+
+    quadruple_generator = context.quadruple_generator
+    quadruples = quadruple_generator.quadruples
+    if optimize and len(quadruples) <= MAX_OPTIMIZED_QUADRUPLES:
+        quadruples = optimize_quadruples(quadruples, quadruple_generator,
+                                         context.directory,
+                                         keep_bounds_checks)
+
+    mark_pure_functions(quadruples, context.directory)
+    instructions = decode_program(quadruples)
+    program = CompiledProgram(quadruples, instructions,
+                              quadruple_generator.constant_table(),
+                              context.directory)
+
+    if note_path is not None:
+        write_note(program, note_path)
+
+    return program
+
 
+def write_note(program, note_path):
+    """ Write a compiled program's quadruples in a .note file """
+    with open(note_path, 'w') as file:
+        file.write('\n'.join(program.quadruples))
 
-def parse_file(path, inputs=None):
-    """ Parse a single file from a path. Returns a list with the output """
-    parser = create_parser(path, inputs)
 
+# Compiled programs shared by every execution of the same source code
+program_cache = ProgramCache(compile_program)
+
+
+def run_program(program, inputs=None, max_steps=None, timeout=None,
+                max_call_depth=None, engine='dispatch', memoize=True,
+                allow_unconsumed_input=False, output=None):
+    """Run a compiled program. Returns the result of its output sink, which
+    is its printed text and its notes unless another sink is given
+
+    inputs is a string with one input line per text line or an iterable of
+    lines (like an open file), which is read lazily. The program must read
+    every line, unless allow_unconsumed_input is True.
+
+    max_steps, timeout (in seconds) and max_call_depth (nested function calls)
+    bound the execution, which raises ExecutionLimitExceeded when it goes over
+    any of them. The engine is one of the names in ENGINES. Calls to pure
+    functions are memoized unless requested otherwise (e.g. to show how many
+    calls a recursive function makes)
+    """
+    try:
+        play = ENGINES[engine]
+    except KeyError:
+        raise ValueError(f'Unknown engine {engine}. Use one of these: '
+                         f'{", ".join(ENGINES)}')
+
+    orchestra = Orchestra(program.constants, program.directory, inputs,
+                          max_steps, timeout, max_call_depth, memoize,
+                          allow_unconsumed_input, output)
+    return play(orchestra, program)
+
+
+def stream_program(program, inputs=None, max_pending=1024, **options):
+    """Run a compiled program in another thread, generating its output while
+    it's produced
+
+    Generates ('print', text) and ('note', note) pairs. The program waits
+    when max_pending of them haven't been read yet. The options are the ones
+    of run_program. An error of the program is raised after the output that
+    came before it, and closing the generator early stops the program
+    """
+    output = StreamOutput(max_pending)
+    errors = []
+
+    def run():
+        try:
+            run_program(program, inputs, output=output, **options)
+        except OutputClosed:
+            return
+        except Exception as e:
+            errors.append(e)
+
+        try:
+            # Marks the end of the output
+            output.put(None)
+        except OutputClosed:
+            pass
+
+    thread = Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = output.queue.get()
+            if item is None:
+                break
+            yield item
+    finally:
+        output.close()
+
+    thread.join()
+    if errors:
+        raise errors[0]
+
+
+def execute_code(source, inputs=None, note_path=None, max_steps=None,
+                 timeout=None, max_call_depth=None, engine='dispatch',
+                 memoize=True, allow_unconsumed_input=False, output=None,
+                 keep_bounds_checks=False):
+    """Compile and run a program's source code without touching any file
+
+    Compiled programs are taken from the program cache when possible.
+    keep_bounds_checks is passed to compile_program. The inputs, the
+    execution limits, the engine and the rest of the options are the same as
+    in run_program
+    """
+    program = program_cache.compile(source,
+                                    keep_bounds_checks=keep_bounds_checks)
+
+    if note_path is not None:
+        write_note(program, note_path)
+
+    return run_program(program, inputs, max_steps, timeout, max_call_depth,
+                       engine, memoize, allow_unconsumed_input, output)
+
+
+def parse_file(path, inputs=None, save_note=False, engine='dispatch',
+               keep_bounds_checks=False):
+    """Parse a single file from a path. Returns a list with the output
+
+    If requested, the quadruples are written next to the file (with a .note
+    extension instead of .sym). The engine and keep_bounds_checks are the
+    same as in execute_code
+    """
     with open(path) as file:
-        parser.parse(file.read())
-
-    with open(quadruple_generator.filepath) as file:
-        # Invert the constant's dictionary to address -> value
-        constants = {type_: {address: value for value, address in
-                             value_address.items()}
-                     for type_, value_address in
-                     quadruple_generator.CONSTANT_ADDRESS_DICT.items()}
-
-        global directory
-        prints, notes = play_note(file.read(), constants, directory,
-                                  quadruple_generator.inputs)
-        return ''.join(prints), notes
+        source = file.read()
+
+    note_path = path[:-4] + '.note' if save_note else None
+    return execute_code(source, inputs, note_path, engine=engine,
+                        keep_bounds_checks=keep_bounds_checks)
 
 
 def parse(files=argv[1:]):
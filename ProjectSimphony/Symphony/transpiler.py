@@ -0,0 +1,384 @@
+"""Execution engine running programs transpiled into Python functions.
+
+A decoded program is turned into the source of a single Python function: its
+basic blocks become the branches of a state machine (a `while` loop over the
+current block, dispatched through a tree of `if` statements) and the global and
+temporal variables become the function's own locals, so a loop runs at the
+speed of CPython's bytecode instead of calling a handler per quadruple.
+
+Functions are blocks of the same state machine too. GOSUB and ENDPROC still go
+through the Orchestra, which keeps the activation records, and the local
+sector is always read from the current frame. Addresses which the Orchestra
+must be able to read or write (arguments and results of special functions)
+stay in the memory dictionaries. The elements of global arrays and the flags
+of the ones assigned are bound to locals once.
+
+The source is compiled once per program (see transpile) and the code object is
+cached in the compiled program, so running it again only creates a function.
+"""
+
+from Symphony.lexer import OPERATORS, DUPLICATED_OPERATORS
+from Symphony.orchestra import (OPCODES, ARRAY_TYPECODES, sector_of,
+                                uninitialized_error, division_error,
+                                index_error)
+
+
+# File name shown by tracebacks of transpiled programs
+SOURCE_NAME = '<symphony>'
+
+# Python names of the memory sector dictionaries inside the function
+SECTOR_NAMES = {
+    'global_' : 'G',
+    'temporal' : 'T',
+    'constant' : 'C',
+    'local' : 'L',
+}
+
+# Python operator of every Symphony operation with two operands
+BINARY_OPERATORS = {
+    '+' : '+',
+    '-' : '-',
+    '*' : '*',
+    '/' : '/',
+    '**' : '**',
+    'mod' : '%',
+    'equals' : '==',
+    '>' : '>',
+    '<' : '<',
+    '>=' : '>=',
+    '<=' : '<=',
+    'and' : '&',
+    'or' : '|',
+}
+
+# Operations which raise a ZeroDivisionError for some operands
+DIVISIONS = {'/', 'mod', '**'}
+
+# Python expression of every operation with a single operand
+UNARY_EXPRESSIONS = {
+    '++' : '1 + {}',
+    '--' : '{} - 1',
+    DUPLICATED_OPERATORS['+'] : '+{}',
+    DUPLICATED_OPERATORS['-'] : '-{}',
+    'not' : 'not {}',
+    '=' : '{}',
+}
+
+# Instructions which always end a basic block
+JUMPS = {'GOTO', 'GOTOF', 'GOSUB', 'ENDPROC', 'TAILCALL'}
+
+# Orchestra methods running the instructions which change the local frame
+CALLS = {
+    'GOSUB' : 'gosub',
+    'TAILCALL' : 'tail_call',
+    'ENDPROC' : 'end_proc',
+}
+
+# Instructions compiled without going through their handler
+INLINED = set(OPERATORS) | set(UNARY_EXPRESSIONS) | JUMPS | {
+    'PARAM', 'LOAD', 'STORE', 'LOADU', 'STOREU'}
+
+# Handler of a missing value read from a memory dictionary
+MISSING_VALUE = ('except KeyError as e:',
+                 '    raise uninitialized_error() from e')
+
+# Names every transpiled function can use besides its own locals
+RUNTIME = {
+    'OPCODES' : OPCODES,
+    'uninitialized_error' : uninitialized_error,
+    'division_error' : division_error,
+    'index_error' : index_error,
+}
+
+
+class Transpiler():
+    """Generate the Python source of a decoded program
+
+    The source defines run(vm), which runs the program in an Orchestra (output
+    and errors included) and leaves the cleanup to the caller
+    """
+    def __init__(self, program, directory):
+        self.program = program
+        self.directory = directory
+        self.lines = []
+        # Constants and special functions bound once before running
+        self.constants = set()
+        self.specials = {}
+        self.shared = self.shared_addresses()
+        # Arrays whose elements may not fit in their array module's array
+        self.typed_arrays = {base_address for function
+                             in directory.functions.values()
+                             for base_address, type_, _ in function.arrays
+                             if type_ in ARRAY_TYPECODES}
+
+
+    def shared_addresses(self):
+        """Return the global and temporal addresses kept in memory
+
+        These are the ones the Orchestra reads or writes by itself (memoized
+        results included) and the ones the function itself never writes,
+        which would be locals without any assignment
+        """
+        shared = set()
+        read = set()
+        written = set()
+        for instruction in self.program:
+            opcode, operands = instruction.opcode, instruction.operands
+            addresses = [operand for operand in operands
+                         if isinstance(operand, int)]
+
+            if opcode not in INLINED or opcode == 'PARAM':
+                shared.update(addresses)
+            elif (opcode in OPERATORS or opcode in UNARY_EXPRESSIONS
+              or opcode in ('LOAD', 'LOADU')):
+                written.add(operands[-1])
+            read.update(addresses)
+
+        shared.update(read - written)
+
+        shared.update(function.return_address for function
+                      in self.directory.functions.values() if function.pure)
+
+        return shared
+
+
+    def operand(self, address):
+        """ Return the Python expression reading or writing an address """
+        sector = sector_of(address)
+
+        if sector == 'constant':
+            self.constants.add(address)
+            return f'c{address}'
+        elif sector in ('global_', 'temporal') and address not in self.shared:
+            return f'v{address}'
+
+        return f'{SECTOR_NAMES[sector]}[{address}]'
+
+
+    def leaders(self):
+        """ Return the sorted indices where a basic block starts """
+        end = len(self.program)
+        leaders = {0, end}
+
+        for quad_idx, instruction in enumerate(self.program):
+            opcode, operands = instruction.opcode, instruction.operands
+
+            if opcode in JUMPS:
+                leaders.add(quad_idx + 1)
+            if opcode == 'GOTO':
+                leaders.add(operands[0])
+            elif opcode == 'GOTOF':
+                leaders.add(operands[1])
+            elif opcode in ('GOSUB', 'TAILCALL'):
+                function = self.directory.functions[operands[0]]
+                leaders.add(function.starting_quad)
+
+        return sorted(leader for leader in leaders if 0 <= leader <= end)
+
+
+    def emit(self, indent, *lines):
+        self.lines.extend('    ' * indent + line for line in lines)
+
+
+    def emit_reading(self, indent, operands, *lines):
+        """Emit statements reading some operands
+
+        A value missing from the memory dictionaries is an uninitialized
+        variable, but any other KeyError is left alone
+        """
+        if any(operand.endswith(']') for operand in operands):
+            self.emit(indent, 'try:', *('    ' + line for line in lines),
+                      *MISSING_VALUE)
+        else:
+            self.emit(indent, *lines)
+
+
+    def jump(self, indent, quad_idx, target):
+        """ Emit a jump to a known block, counting it if the run is limited """
+        self.emit(indent, f'block = jumped({quad_idx}, {target}) '
+                          f'if limited else {target}')
+
+
+    def storage(self, indent, base_address, offset_address, array_size):
+        """Emit the bounds check of an array access
+
+        Returns the expressions of the array's storage, its elements and its
+        assigned flags. Unchecked accesses have no size
+        """
+        offset = self.operand(offset_address)
+        self.emit_reading(indent, [offset], f'offset = {offset}')
+        if array_size is not None:
+            self.emit(indent,
+                      f'if not 0 <= offset < {array_size}:',
+                      f'    raise index_error(offset, {array_size})')
+
+        if sector_of(base_address) == 'local':
+            self.emit(indent, f'array = L[{base_address}]')
+            return 'array', 'array.values', 'array.assigned'
+
+        array = f'a{base_address}'
+        return array, f'{array}_values', f'{array}_assigned'
+
+
+    def instruction(self, indent, quad_idx, instruction):
+        """ Emit the statements of a single instruction """
+        opcode, operands = instruction.opcode, instruction.operands
+
+        if opcode in OPERATORS:
+            address1, address2, result_address = map(self.operand, operands)
+            statement = (f'{result_address} = {address1} '
+                         f'{BINARY_OPERATORS[opcode]} {address2}')
+
+            if opcode in DIVISIONS:
+                self.emit(indent,
+                          'try:',
+                          f'    {statement}',
+                          'except ZeroDivisionError as e:',
+                          f'    raise division_error({address1}) from e')
+                if address1.endswith(']') or address2.endswith(']'):
+                    self.emit(indent, *MISSING_VALUE)
+            else:
+                self.emit_reading(indent, [address1, address2], statement)
+        elif opcode in UNARY_EXPRESSIONS:
+            address, result_address = map(self.operand, operands)
+            expression = UNARY_EXPRESSIONS[opcode].format(address)
+            self.emit_reading(indent, [address],
+                              f'{result_address} = {expression}')
+        elif opcode == 'GOTO':
+            self.jump(indent, quad_idx, operands[0])
+        elif opcode == 'GOTOF':
+            condition = self.operand(operands[0])
+            if condition.endswith(']'):
+                self.emit_reading(indent, [condition],
+                                  f'condition = {condition}')
+                condition = 'condition'
+            self.emit(indent, f'if not {condition}:')
+            self.jump(indent + 1, quad_idx, operands[1])
+            self.emit(indent, 'else:',
+                      f'    block = {quad_idx + 1}')
+        elif opcode in CALLS:
+            arguments = ', '.join(map(repr, operands))
+            self.emit(indent,
+                      f'block = {CALLS[opcode]}({arguments})',
+                      "L = memory['local']",
+                      'if limited:',
+                      f'    block = jumped({quad_idx}, block)')
+        elif opcode == 'PARAM':
+            self.emit(indent, f'parameters.append({operands[0]})')
+        elif opcode in ('LOAD', 'LOADU'):
+            *access, result_address = operands
+            if opcode == 'LOADU':
+                access.append(None)
+            _, values, assigned = self.storage(indent, *access)
+            self.emit(indent,
+                      f'if not {assigned}[offset]:',
+                      '    raise uninitialized_error()',
+                      f'{self.operand(result_address)} = {values}[offset]')
+        elif opcode in ('STORE', 'STOREU'):
+            value_address, *access = operands
+            if opcode == 'STOREU':
+                access.append(None)
+            array, values, assigned = self.storage(indent, *access)
+            value = self.operand(value_address)
+            if value.endswith(']'):
+                self.emit_reading(indent, [value], f'value = {value}')
+                value = 'value'
+            if access[0] in self.typed_arrays:
+                # The storage moves its elements to a list when one doesn't
+                # fit, so they are bound again
+                self.emit(indent,
+                          'try:',
+                          f'    {values}[offset] = {value}',
+                          'except (TypeError, OverflowError):',
+                          f'    {array}.store(offset, {value})')
+                if array != 'array':
+                    self.emit(indent, f'    {values} = {array}.values')
+            else:
+                self.emit(indent, f'{values}[offset] = {value}')
+            self.emit(indent, f'{assigned}[offset] = True')
+        else:
+            special = self.specials.setdefault(opcode,
+                                               f'special{len(self.specials)}')
+            arguments = ''.join(f', {operand}' for operand in operands)
+            self.emit(indent, f'{special}(vm{arguments})')
+
+
+    def block(self, indent, leader, next_leader):
+        """ Emit the statements of the basic block starting at a leader """
+        if leader == len(self.program):
+            self.emit(indent, 'break')
+            return
+
+        for quad_idx in range(leader, next_leader):
+            self.instruction(indent, quad_idx, self.program[quad_idx])
+
+        if self.program[next_leader - 1].opcode not in JUMPS:
+            self.emit(indent, f'block = {next_leader}')
+
+
+    def dispatch(self, indent, leaders, next_leaders):
+        """ Emit a binary tree of ifs selecting the current block """
+        if len(leaders) == 1:
+            self.block(indent, leaders[0], next_leaders[0])
+            return
+
+        middle = len(leaders) // 2
+        self.emit(indent, f'if block < {leaders[middle]}:')
+        self.dispatch(indent + 1, leaders[:middle], next_leaders[:middle])
+        self.emit(indent, 'else:')
+        self.dispatch(indent + 1, leaders[middle:], next_leaders[middle:])
+
+
+    def source(self):
+        """ Return the source of the program's function """
+        leaders = self.leaders()
+        self.dispatch(3, leaders, leaders[1:] + [None])
+        body = self.lines
+
+        self.lines = []
+        self.emit(0, 'def run(vm):')
+        self.emit(1,
+                  'memory = vm.memory',
+                  "G, T = memory['global_'], memory['temporal']",
+                  "C, L = memory['constant'], memory['local']",
+                  'parameters = vm.parameters',
+                  'gosub, tail_call = vm.gosub, vm.tail_call',
+                  'end_proc, jumped = vm.end_proc, vm.jumped',
+                  'limited = vm.start_limits()',
+                  'block = 0')
+        for opcode, special in self.specials.items():
+            self.emit(1, f'{special} = OPCODES[{opcode!r}].handler')
+
+        global_scope = self.directory.functions[self.directory.GLOBAL_SCOPE]
+        for base_address, _, _ in global_scope.arrays:
+            array = f'a{base_address}'
+            self.emit(1, f'{array} = G[{base_address}]',
+                      f'{array}_values = {array}.values',
+                      f'{array}_assigned = {array}.assigned')
+
+        self.emit(1, 'try:')
+        for address in sorted(self.constants):
+            self.emit(2, f'c{address} = C[{address}]')
+        self.emit(2, 'while True:')
+        self.lines.extend(body)
+        # Symphony variables kept as locals raise an UnboundLocalError when
+        # they weren't assigned
+        self.emit(1, 'except UnboundLocalError as e:',
+                  '    raise uninitialized_error() from e')
+
+        return '\n'.join(self.lines) + '\n'
+
+
+def transpile(program, directory):
+    """ Compile a decoded program into the code object of its function """
+    return compile(Transpiler(program, directory).source(), SOURCE_NAME,
+                   'exec')
+
+
+def play_transpiled(vm, code):
+    """ Run the code object of a transpiled program and return its output """
+    namespace = dict(RUNTIME)
+    exec(code, namespace)
+    namespace['run'](vm)
+
+    return vm.output_after_cleanup()
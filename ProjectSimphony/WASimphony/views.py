@@ -7,8 +7,10 @@ from django.http import HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from django.http import HttpResponse
 from .models import FileDb
-from Symphony.symphony_parser import parse_file
+from Symphony.symphony_parser import execute_code
+from Symphony.output_sinks import BufferedOutput
 from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
 import os.path
 from os.path import join
 import logging
@@ -120,17 +122,20 @@ def execute_code_view(request):
         program = request.POST.get('program', None)
         inputs = request.POST.get('inputs', None)
 
-        BASE = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(BASE, "test.sym")
-        #print(file_path)
-        with open(file_path, 'w+') as f:
-            f.write(program)
-
         try:
             if inputs == '':
                 inputs = None
 
-            prints, notes = parse_file(file_path, inputs)
+            output = BufferedOutput(settings.SYMPHONY_MAX_OUTPUT,
+                                    settings.SYMPHONY_MAX_NOTES)
+            prints, notes = execute_code(
+                program, inputs, max_steps=settings.SYMPHONY_MAX_STEPS,
+                timeout=settings.SYMPHONY_TIMEOUT,
+                max_call_depth=settings.SYMPHONY_MAX_CALL_DEPTH,
+                memoize=settings.SYMPHONY_MEMOIZE, output=output,
+                keep_bounds_checks=settings.SYMPHONY_KEEP_BOUNDS_CHECKS)
+            if output.truncated:
+                prints += '\n(The output was too long and was cut short)'
             prints = prints.replace('\n', '<br>')
             logger.critical(prints)
             logger.critical(notes)